@@ -1,7 +1,13 @@
+import os
+import threading
+import time
 from typing import List
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-import mysql.connector
+import db
+import tracing
+import fastjson
+import mysql.connector  # type: ignore
 from jose import jwt, JWTError  # type: ignore
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
@@ -16,11 +22,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(tracing.TraceMiddleware, service="addresses")
 
-mydb = mysql.connector.connect(
-    host="mysql", user="user", password="password", database="flowerstore"
-)
-mycursor = mydb.cursor(dictionary=True)
+mydb = db.primary
 
 SECRET_KEY = "florist"
 ALGORITHM = "HS256"
@@ -67,34 +71,96 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
         raise HTTPException(status_code=401, detail="Could not validate credentials")
 
 
+# each user's current address (including None = no address yet) is read on
+# every checkout and order page, so it is kept in memory. Every endpoint that
+# writes addresses must invalidate that user; the TTL is only a safety net
+CURRENT_ADDRESS_TTL = float(os.environ.get("CURRENT_ADDRESS_CACHE_TTL", "300"))
+CURRENT_ADDRESS_CACHE_SIZE = int(os.environ.get("CURRENT_ADDRESS_CACHE_SIZE", "100000"))
+MAX_BATCH_IDS = 500
+
+
+class CurrentAddressCache:
+    def __init__(self, ttl=CURRENT_ADDRESS_TTL, size=CURRENT_ADDRESS_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = {}  # user_id -> (expires at, address row or None)
+        # bumped on every invalidate, so a read that started before a write
+        # cannot put its (now stale) result back afterwards
+        self._versions = {}
+
+    def get(self, user_id):
+        """Returns (found, address row or None)."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            return False, None
+        return True, entry[1]
+
+    def version(self, user_id):
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def put(self, user_id, address, version):
+        with self._lock:
+            if self._versions.get(user_id, 0) != version:
+                return
+            if len(self._entries) >= self.size:
+                self._entries.clear()
+            self._entries[user_id] = (time.monotonic() + self.ttl, address)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._entries.pop(user_id, None)
+
+
+current_addresses = CurrentAddressCache()
+
+
+def address_to_dict(row):
+    """An addresses row in the AddressResponse shape, for fastjson."""
+    return {**row, "is_current": bool(row["is_current"])}
+
+
+def address_written(user_id):
+    db.note_write(user_id)
+    current_addresses.invalidate(user_id)
+
+
 @app.post("/api/addresses/add_address", response_model=AddressResponse, status_code=201)
 def add_address(address: Address, current_user: TokenData = Depends(get_current_user)):
-    mycursor.execute("SELECT * FROM users WHERE user_id = %s", (address.user_id,))
-    if not mycursor.fetchone():
-        raise HTTPException(status_code=404, detail="User not found")
-    mycursor.execute(
-        "SELECT * FROM addresses WHERE user_id = %s AND is_current = True",
-        (address.user_id,),
-    )
-    if mycursor.fetchone():
-        mycursor.execute(
-            "UPDATE addresses SET is_current = False WHERE user_id = %s",
-            (address.user_id,),
+    cursor = mydb.cursor()
+    try:
+        db.begin(mydb)
+        cursor.execute(
+            "INSERT INTO addresses (user_id, address, city, state, zip_code, country, is_current) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+            (
+                address.user_id,
+                address.address,
+                address.city,
+                address.state,
+                address.zip_code,
+                address.country,
+                address.is_current,
+            ),
         )
-    mycursor.execute(
-        "INSERT INTO addresses (user_id, address, city, state, zip_code, country, is_current) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-        (
-            address.user_id,
-            address.address,
-            address.city,
-            address.state,
-            address.zip_code,
-            address.country,
-            address.is_current,
-        ),
-    )
-    mydb.commit()
-    return AddressResponse(address_id=mycursor.lastrowid, **address.dict())
+        address_id = cursor.lastrowid
+        if address.is_current:
+            cursor.execute(
+                "UPDATE addresses SET is_current = False WHERE user_id = %s AND is_current AND address_id <> %s",
+                (address.user_id, address_id),
+            )
+        mydb.commit()
+    except mysql.connector.IntegrityError:
+        # foreign key on user_id: no such user
+        mydb.rollback()
+        raise HTTPException(status_code=404, detail="User not found")
+    except Exception:
+        mydb.rollback()
+        raise
+    address_written(address.user_id)
+    return AddressResponse(address_id=address_id, **address.dict())
 
 
 @app.get(
@@ -103,8 +169,34 @@ def add_address(address: Address, current_user: TokenData = Depends(get_current_
 def get_addresses_by_user_id(
     user_id: int, current_user: TokenData = Depends(get_current_user)
 ):
-    mycursor.execute("SELECT * FROM addresses WHERE user_id = %s", (user_id,))
-    return [AddressResponse(**address) for address in mycursor.fetchall()]
+    cursor = db.reader(user_id).cursor(dictionary=True)
+    cursor.execute("SELECT * FROM addresses WHERE user_id = %s", (user_id,))
+    return fastjson.response([address_to_dict(row) for row in cursor.fetchall()])
+
+
+@app.get(
+    "/api/addresses/get_addresses_by_ids", response_model=List[AddressResponse]
+)
+def get_addresses_by_ids(
+    address_ids: str = Query(..., description="Comma separated address ids"),
+    current_user: TokenData = Depends(get_current_user),
+):
+    try:
+        ids = sorted({int(i) for i in address_ids.split(",") if i.strip()})
+    except ValueError:
+        raise HTTPException(status_code=400, detail="address_ids must be integers")
+    if not ids:
+        return []
+    if len(ids) > MAX_BATCH_IDS:
+        raise HTTPException(
+            status_code=400, detail=f"At most {MAX_BATCH_IDS} address ids per request"
+        )
+    cursor = db.reader().cursor(dictionary=True)
+    cursor.execute(
+        f"SELECT * FROM addresses WHERE address_id IN ({', '.join(['%s'] * len(ids))})",
+        tuple(ids),
+    )
+    return fastjson.response([address_to_dict(row) for row in cursor.fetchall()])
 
 
 @app.get(
@@ -113,13 +205,18 @@ def get_addresses_by_user_id(
 def get_current_address_by_user_id(
     user_id: int, current_user: TokenData = Depends(get_current_user)
 ):
-    mycursor.execute(
-        "SELECT * FROM addresses WHERE user_id = %s AND is_current = True", (user_id,)
-    )
-    address = mycursor.fetchone()
+    found, address = current_addresses.get(user_id)
+    if not found:
+        version = current_addresses.version(user_id)
+        cursor = db.reader(user_id).cursor(dictionary=True)
+        cursor.execute(
+            "SELECT * FROM addresses WHERE user_id = %s AND is_current = True", (user_id,)
+        )
+        address = cursor.fetchone()
+        current_addresses.put(user_id, address, version)
     if address is None:
         raise HTTPException(status_code=404, detail="No current address found")
-    return AddressResponse(**address)
+    return fastjson.response(address_to_dict(address))
 
 
 @app.put("/api/addresses/edit_address_by_address_id", response_model=AddressResponse)
@@ -128,11 +225,12 @@ def edit_address_by_address_id(
     address: Address,
     current_user: TokenData = Depends(get_current_user),
 ):
-    mycursor.execute("SELECT * FROM addresses WHERE address_id = %s", (address_id,))
-    existing_address = mycursor.fetchone()
+    cursor = mydb.cursor(dictionary=True)
+    cursor.execute("SELECT * FROM addresses WHERE address_id = %s", (address_id,))
+    existing_address = cursor.fetchone()
     if not existing_address:
         raise HTTPException(status_code=404, detail="Address not found")
-    mycursor.execute(
+    cursor.execute(
         "UPDATE addresses SET address = %s, city = %s, state = %s, zip_code = %s, country = %s WHERE address_id = %s",
         (
             address.address,
@@ -144,6 +242,7 @@ def edit_address_by_address_id(
         ),
     )
     mydb.commit()
+    address_written(existing_address["user_id"])
     return AddressResponse(**{**existing_address, **address.dict()})
 
 
@@ -151,11 +250,14 @@ def edit_address_by_address_id(
 def delete_address_by_address_id(
     address_id: int, current_user: TokenData = Depends(get_current_user)
 ):
-    mycursor.execute("SELECT * FROM addresses WHERE address_id = %s", (address_id,))
-    if not mycursor.fetchone():
+    cursor = mydb.cursor(dictionary=True)
+    cursor.execute("SELECT * FROM addresses WHERE address_id = %s", (address_id,))
+    address = cursor.fetchone()
+    if not address:
         raise HTTPException(status_code=404, detail="Address not found")
-    mycursor.execute("DELETE FROM addresses WHERE address_id = %s", (address_id,))
+    cursor.execute("DELETE FROM addresses WHERE address_id = %s", (address_id,))
     mydb.commit()
+    address_written(address["user_id"])
     return {"message": "Deleted successfully"}
 
 
@@ -165,16 +267,27 @@ def delete_address_by_address_id(
 def set_current_address_by_address_id(
     address_id: int, current_user: TokenData = Depends(get_current_user)
 ):
-    mycursor.execute("SELECT * FROM addresses WHERE address_id = %s", (address_id,))
-    address = mycursor.fetchone()
+    cursor = mydb.cursor(dictionary=True)
+    try:
+        db.begin(mydb)
+        # all of the user's addresses in one statement: the chosen one
+        # becomes current, the others are cleared
+        cursor.execute(
+            """
+            UPDATE addresses a
+            JOIN addresses target ON target.user_id = a.user_id
+            SET a.is_current = (a.address_id = target.address_id)
+            WHERE target.address_id = %s
+        """,
+            (address_id,),
+        )
+        cursor.execute("SELECT * FROM addresses WHERE address_id = %s", (address_id,))
+        address = cursor.fetchone()
+        mydb.commit()
+    except Exception:
+        mydb.rollback()
+        raise
     if not address:
         raise HTTPException(status_code=404, detail="Address not found")
-    mycursor.execute(
-        "UPDATE addresses SET is_current = False WHERE user_id = %s",
-        (address["user_id"],),
-    )
-    mycursor.execute(
-        "UPDATE addresses SET is_current = True WHERE address_id = %s", (address_id,)
-    )
-    mydb.commit()
+    address_written(address["user_id"])
     return AddressResponse(**address)
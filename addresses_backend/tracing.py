@@ -0,0 +1,255 @@
+"""Request tracing across nginx and the backends.
+
+Every service keeps an identical copy of this module (like db.py).
+
+``TraceMiddleware`` starts a server span per request. It continues the trace
+from an incoming W3C ``traceparent`` header, or else uses nginx's
+``X-Request-ID`` (32 hex characters, which is also a valid trace id). It
+echoes the trace id back as ``X-Request-ID``. Code inside the request adds
+child spans with ``span(name, **attributes)``: db.py does this for every
+query and commit, auth for bcrypt, products for the TTS calls. Outside a
+request (background jobs) ``span`` records nothing.
+
+Finished spans go to ``exporter``, picked at import time:
+
+- ``TRACE_FILE``: one JSON object per line, appended to that file.
+- ``OTEL_EXPORTER_OTLP_ENDPOINT``: OTLP/HTTP JSON, batched, posted to
+  <endpoint>/v1/traces (any OpenTelemetry collector, Jaeger, Tempo, ...).
+- neither: spans are not recorded, only the ids are propagated.
+
+Tests can swap it: ``tracing.exporter = tracing.MemoryExporter()``.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+import urllib.request
+
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+REQUEST_ID = re.compile(r"^[0-9a-f]{32}$")
+
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id, service, kind=INTERNAL, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.service = service
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+
+    def finish(self):
+        self.end = time.time_ns()
+        if exporter is not None:
+            exporter.export(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "service": self.service,
+            "name": self.name,
+            "kind": self.kind,
+            "start": self.start,
+            "duration_ms": (self.end - self.start) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def current_span():
+    return _current.get()
+
+
+@contextlib.contextmanager
+def span(name, kind=INTERNAL, **attributes):
+    parent = _current.get()
+    if parent is None or exporter is None:
+        yield None
+        return
+    child = Span(name, parent.trace_id, parent.span_id, parent.service, kind, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+def _incoming_trace(headers):
+    match = TRACEPARENT.match(headers.get(b"traceparent", b"").decode("latin-1"))
+    if match and match.group(1) != "0" * 32:
+        return match.group(1), match.group(2)
+    request_id = headers.get(b"x-request-id", b"").decode("latin-1").lower()
+    if REQUEST_ID.match(request_id) and request_id != "0" * 32:
+        return request_id, None
+    return secrets.token_hex(16), None
+
+
+class TraceMiddleware:
+    def __init__(self, app, service):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace_id, parent_id = _incoming_trace(dict(scope["headers"]))
+        server = Span(
+            f"{scope['method']} {scope['path']}",
+            trace_id,
+            parent_id,
+            self.service,
+            SERVER,
+            {"http.method": scope["method"], "http.target": scope["path"]},
+        )
+        token = _current.set(server)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                server.attributes["http.status_code"] = message["status"]
+                if message["status"] >= 500:
+                    server.error = f"HTTP {message['status']}"
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-request-id", trace_id.encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        except Exception as e:
+            server.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            route = scope.get("route")
+            if getattr(route, "path", None):
+                server.name = f"{scope['method']} {route.path}"
+            _current.reset(token)
+            server.finish()
+
+
+class MemoryExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class FileExporter:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self._lock, open(self.path, "a") as f:
+            f.write(line)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(span):
+    data = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": span.kind,
+        "startTimeUnixNano": str(span.start),
+        "endTimeUnixNano": str(span.end),
+        "attributes": [
+            {"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()
+        ],
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+    }
+    if span.parent_id:
+        data["parentSpanId"] = span.parent_id
+    return data
+
+
+class OTLPExporter:
+    """Posts spans to an OTLP/HTTP collector from a background thread."""
+
+    def __init__(self, endpoint, batch_size=512, interval=2.0, max_queue=10000):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(max_queue)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def export(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            pass  # collector down or too slow; drop rather than slow requests
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.post(batch)
+            except Exception as e:
+                print(f"trace export failed: {e}")
+
+    def post(self, spans):
+        by_service = {}
+        for span in spans:
+            by_service.setdefault(span.service, []).append(_otlp_span(span))
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {"key": "service.name", "value": {"stringValue": service}}
+                        ]
+                    },
+                    "scopeSpans": [{"scope": {"name": "flowerstore"}, "spans": otlp_spans}],
+                }
+                for service, otlp_spans in by_service.items()
+            ]
+        }
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        urllib.request.urlopen(request, timeout=5).close()
+
+
+exporter = None
+if os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT"):
+    exporter = OTLPExporter(os.environ["OTEL_EXPORTER_OTLP_ENDPOINT"])
+elif os.environ.get("TRACE_FILE"):
+    exporter = FileExporter(os.environ["TRACE_FILE"])
@@ -0,0 +1,265 @@
+"""Connections to the flowerstore database.
+
+Every service keeps an identical copy of this module (each one is its own
+Docker build context).
+
+Writes go to the primary (``db.primary``). Reads that can tolerate a few
+seconds of staleness ask ``db.reader()`` for a connection and are spread over
+the replicas listed in ``MYSQL_REPLICA_HOSTS``. A background thread polls
+``SHOW SLAVE STATUS`` on every replica and takes a replica out of rotation
+while its lag is above ``MYSQL_REPLICA_MAX_LAG`` seconds, replication is
+stopped or the host does not answer. With no healthy replica (or none
+configured) ``reader()`` simply returns the primary.
+
+``db.primary`` and the replica connections hand every thread its own
+connection (created on first use and kept for the life of the thread):
+handlers run in a thread pool and a MySQL connection must never be used by
+two threads at once. When all services run in one process (combined.py)
+they share this module and so share the connections.
+
+Every connection is in autocommit mode. A pooled thread's connection lives
+on between requests, and a plain read must not leave a transaction open on
+it: under REPEATABLE READ that transaction's snapshot would hide later
+commits from other threads, and its metadata locks would block DDL (e.g.
+archive.ensure_partitions). Writes that span several statements or lock
+rows with FOR UPDATE call ``begin(conn)`` first and end with commit() or
+rollback().
+
+Every connection from ``connect()`` records a tracing span (see tracing.py)
+for each query and commit made while a request is being traced.
+
+Read-your-own-writes: a handler that writes on behalf of some key (usually a
+user id) calls ``note_write(key)``; ``reader(key)`` then keeps that key on the
+primary for ``MYSQL_READ_YOUR_WRITES_WINDOW`` seconds.
+"""
+
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import mysql.connector  # type: ignore
+
+import tracing
+
+DB_USER = os.environ.get("MYSQL_USER", "user")
+DB_PASSWORD = os.environ.get("MYSQL_PASSWORD", "password")
+DB_NAME = os.environ.get("MYSQL_DATABASE", "flowerstore")
+PRIMARY_HOST = os.environ.get("MYSQL_HOST", "mysql")
+# comma separated, each entry either "host" or "host:port"
+REPLICA_HOSTS = [
+    host.strip()
+    for host in os.environ.get("MYSQL_REPLICA_HOSTS", "").split(",")
+    if host.strip()
+]
+REPLICA_MAX_LAG = float(os.environ.get("MYSQL_REPLICA_MAX_LAG", "5"))
+REPLICA_CHECK_INTERVAL = float(os.environ.get("MYSQL_REPLICA_CHECK_INTERVAL", "2"))
+READ_YOUR_WRITES_WINDOW = float(os.environ.get("MYSQL_READ_YOUR_WRITES_WINDOW", "10"))
+CONNECTION_CHECK_INTERVAL = float(os.environ.get("MYSQL_CONNECTION_CHECK_INTERVAL", "1"))
+
+
+def connect(host=PRIMARY_HOST, **kwargs):
+    hostname, _, port = host.partition(":")
+    kwargs.setdefault("autocommit", True)
+    return TracedConnection(
+        mysql.connector.connect(
+            host=hostname,
+            port=int(port or 3306),
+            user=DB_USER,
+            password=DB_PASSWORD,
+            database=DB_NAME,
+            **kwargs,
+        ),
+        host,
+    )
+
+
+class TracedCursor:
+    def __init__(self, cursor, host):
+        self._cursor = cursor
+        self._host = host
+
+    def _span(self, operation):
+        statement = " ".join(str(operation).split())[:500]
+        return tracing.span(
+            "db.query",
+            tracing.CLIENT,
+            **{"db.statement": statement, "net.peer.name": self._host},
+        )
+
+    def execute(self, operation, *args, **kwargs):
+        with self._span(operation):
+            return self._cursor.execute(operation, *args, **kwargs)
+
+    def executemany(self, operation, *args, **kwargs):
+        with self._span(operation):
+            return self._cursor.executemany(operation, *args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class TracedConnection:
+    def __init__(self, conn, host):
+        self._conn = conn
+        self._host = host
+
+    def cursor(self, *args, **kwargs):
+        return TracedCursor(self._conn.cursor(*args, **kwargs), self._host)
+
+    def commit(self):
+        with tracing.span("db.commit", tracing.CLIENT, **{"net.peer.name": self._host}):
+            self._conn.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class ThreadConnections:
+    """Looks like one connection; is one connection per thread."""
+
+    def __init__(self, host=PRIMARY_HOST, **kwargs):
+        self._host = host
+        self._kwargs = kwargs
+        self._local = threading.local()
+
+    def current(self):
+        local = self._local
+        conn = getattr(local, "conn", None)
+        now = time.monotonic()
+        # the connection can die under us (server restart, wait_timeout), so
+        # ping it at most every CONNECTION_CHECK_INTERVAL. Not in the middle
+        # of a transaction, though: a silent reconnect would lose its earlier
+        # statements. A transaction flag left over from a failed request
+        # (nothing used the connection since) does not count.
+        if (
+            conn is not None
+            and now - local.checked_at >= CONNECTION_CHECK_INTERVAL
+            and (not conn.in_transaction or now - local.used_at >= CONNECTION_CHECK_INTERVAL)
+        ):
+            local.checked_at = now
+            if not conn.is_connected():
+                try:
+                    conn.close()
+                except mysql.connector.Error:
+                    pass
+                conn = None
+        if conn is None:
+            conn = local.conn = connect(self._host, **self._kwargs)
+            local.checked_at = now
+        local.used_at = now
+        return conn
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+
+class Replica:
+    def __init__(self, host):
+        self.host = host
+        self.healthy = False
+        self.lag = None
+        self._conn = ThreadConnections(host)
+        self._probe = None
+
+    def connection(self):
+        self._conn.current()
+        return self._conn
+
+    def check(self):
+        try:
+            if self._probe is None or not self._probe.is_connected():
+                self._probe = connect(self.host)
+            cursor = self._probe.cursor(dictionary=True)
+            cursor.execute("SHOW SLAVE STATUS")
+            row = cursor.fetchone()
+            cursor.close()
+        except mysql.connector.Error:
+            self._probe = None
+            row = None
+        # no row means the host is not replicating, NULL means the SQL or IO
+        # thread is stopped; both are treated as "infinitely behind"
+        self.lag = row["Seconds_Behind_Master"] if row else None
+        self.healthy = self.lag is not None and self.lag <= REPLICA_MAX_LAG
+
+
+def begin(conn):
+    """Start a transaction, unless conn is already in one."""
+    if not conn.in_transaction:
+        conn.start_transaction()
+
+
+primary = ThreadConnections()
+replicas = [Replica(host) for host in REPLICA_HOSTS]
+_rotation = itertools.count()
+_recent_writes = OrderedDict()  # key -> time of its last write, oldest first
+_recent_writes_lock = threading.Lock()
+
+
+def note_write(key):
+    now = time.monotonic()
+    with _recent_writes_lock:
+        _recent_writes[key] = now
+        _recent_writes.move_to_end(key)
+        # drop keys whose window has passed, so keys never read back don't
+        # pile up
+        while next(iter(_recent_writes.values())) < now - READ_YOUR_WRITES_WINDOW:
+            _recent_writes.popitem(last=False)
+
+
+def _wrote_recently(key):
+    with _recent_writes_lock:
+        written_at = _recent_writes.get(key)
+        if written_at is None:
+            return False
+        if time.monotonic() - written_at > READ_YOUR_WRITES_WINDOW:
+            del _recent_writes[key]
+            return False
+        return True
+
+
+def reader(key=None):
+    """Connection for a read that may be served slightly stale."""
+    if key is not None and _wrote_recently(key):
+        return primary
+    healthy = [replica for replica in replicas if replica.healthy]
+    if not healthy:
+        return primary
+    replica = healthy[next(_rotation) % len(healthy)]
+    try:
+        return replica.connection()
+    except mysql.connector.Error:
+        replica.healthy = False
+        return primary
+
+
+def connect_reader():
+    """New connection of its own for a long read that may be slightly stale."""
+    healthy = [replica for replica in replicas if replica.healthy]
+    if healthy:
+        return connect(healthy[next(_rotation) % len(healthy)].host)
+    return connect()
+
+
+def replica_status():
+    return [
+        {"host": replica.host, "healthy": replica.healthy, "lag": replica.lag}
+        for replica in replicas
+    ]
+
+
+def _monitor_replicas():
+    while True:
+        for replica in replicas:
+            replica.check()
+        time.sleep(REPLICA_CHECK_INTERVAL)
+
+
+if replicas:
+    for replica in replicas:
+        replica.check()
+    threading.Thread(target=_monitor_replicas, daemon=True).start()
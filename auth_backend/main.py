@@ -12,7 +12,8 @@ from pydantic import BaseModel
 import requests
 
 # import libraries เกี่ยวกับ mysql
-import mysql.connector  # type: ignore
+import db
+import tracing
 
 
 # to get a string like this run:
@@ -21,9 +22,7 @@ SECRET_KEY = "florist"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-mydb = mysql.connector.connect(
-    host="mysql", user="user", password="password", database="flowerstore"
-)
+mydb = db.primary
 
 
 class Token(BaseModel):
@@ -65,18 +64,21 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(tracing.TraceMiddleware, service="auth")
 
 
 def verify_password(plain_password, password_hash):
-    return pwd_context.verify(plain_password, password_hash)
+    with tracing.span("bcrypt.verify"):
+        return pwd_context.verify(plain_password, password_hash)
 
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    with tracing.span("bcrypt.hash"):
+        return pwd_context.hash(password)
 
 
 def get_user(username: str):
-    mycursor = mydb.cursor()
+    mycursor = db.reader(username).cursor()
     mycursor.execute("SELECT * FROM users WHERE username = %s", (username,))
     myresult = mycursor.fetchall()
     if myresult:
@@ -185,6 +187,7 @@ async def register_user(user: User_Register):
     )
     mycursor.execute(sql, val)
     mydb.commit()
+    db.note_write(user.username)
     return {"message": "User created successfully"}
 
 
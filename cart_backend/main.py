@@ -10,12 +10,13 @@ from fastapi import status
 
 
 # import libraries เกี่ยวกับ mysql
-import mysql.connector  # type: ignore
+import db
+import tracing
+import sweeper
 
 
-mydb = mysql.connector.connect(
-    host="mysql", user="user", password="password", database="flowerstore"
-)
+# the cart is read right after it is written, so it always stays on the primary
+mydb = db.primary
 
 from jose import jwt, JWTError  # type: ignore
 
@@ -59,6 +60,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(tracing.TraceMiddleware, service="cart")
 
 
 class CartItem(BaseModel):
@@ -92,37 +94,77 @@ def get_product_details(product_id: int):
     return mycursor.fetchone()
 
 
+@app.on_event("startup")
+def start_cart_sweeper():
+    sweeper.start_background_sweeper()
+
+
+def touch_cart(cursor, user_id):
+    """Get or create the user's cart and mark it active. Returns its cart_id."""
+    # LAST_INSERT_ID(cart_id) makes lastrowid the existing id on a duplicate
+    cursor.execute(
+        """
+        INSERT INTO cart (user_id) VALUES (%s)
+        ON DUPLICATE KEY UPDATE cart_id = LAST_INSERT_ID(cart_id), updated_at = NOW()
+    """,
+        (user_id,),
+    )
+    return cursor.lastrowid
+
+
 @app.post("/api/cart/add_to_cart", status_code=status.HTTP_201_CREATED)
 def add_to_cart(cart: Cart, current_user: TokenData = Depends(get_current_user)):
     mycursor = mydb.cursor()
-    # Ensure there is a cart for the user, get the cart_id
-    query = "SELECT cart_id FROM cart WHERE user_id=%s"
-    mycursor.execute(query, (cart.user_id,))
-    cart_result = mycursor.fetchone()
-    if not cart_result:
-        query = "INSERT INTO cart (user_id) VALUES (%s)"
-        mycursor.execute(query, (cart.user_id,))
-        mydb.commit()
-        cart_id = mycursor.lastrowid  # Get the new cart_id
-    else:
-        cart_id = cart_result[0]
-
-    # Process each item in the cart
-    for item in cart.items:
-        query = "SELECT * FROM cart_items WHERE cart_id=%s AND product_id=%s"
-        mycursor.execute(query, (cart_id, item.product_id))
-        item_result = mycursor.fetchone()
-        if not item_result:
-            query = "INSERT INTO cart_items (cart_id, product_id, quantity) VALUES (%s, %s, %s)"
-            mycursor.execute(query, (cart_id, item.product_id, item.quantity))
-        else:
-            query = "UPDATE cart_items SET quantity = quantity + %s WHERE cart_id = %s AND product_id = %s"
-            mycursor.execute(query, (item.quantity, cart_id, item.product_id))
+    try:
+        db.begin(mydb)
+        cart_id = touch_cart(mycursor, cart.user_id)
+        if cart.items:
+            mycursor.executemany(
+                """
+                INSERT INTO cart_items (cart_id, product_id, quantity) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE quantity = quantity + VALUES(quantity)
+            """,
+                [(cart_id, item.product_id, item.quantity) for item in cart.items],
+            )
         mydb.commit()
+    except Exception:
+        mydb.rollback()
+        raise
 
     return {"message": "Added to cart successfully"}
 
 
+# product columns a cart listing can be narrowed to with ?fields=
+PRODUCT_FIELDS = [
+    "product_id",
+    "category_id",
+    "name",
+    "description",
+    "price",
+    "product_image",
+]
+
+FIELD_PRESETS = {
+    "card": ["product_id", "name", "price", "product_image"],
+    "detail": PRODUCT_FIELDS,
+}
+
+
+def parse_fields(fields: Optional[str]):
+    """Turn "card" or "name,price" into a list of product field names."""
+    if fields is None:
+        return PRODUCT_FIELDS
+    selected = []
+    for field in fields.split(","):
+        field = field.strip()
+        for name in FIELD_PRESETS.get(field, [field]):
+            if name not in PRODUCT_FIELDS:
+                raise HTTPException(status_code=400, detail=f"Unknown field: {name}")
+            if name not in selected:
+                selected.append(name)
+    return selected
+
+
 @app.get("/api/cart/get_cart_pagination", response_model=Dict[str, Any])
 def get_cart(
     user_id: int = Query(
@@ -130,13 +172,16 @@ def get_cart(
     ),
     page: int = Query(1, description="Page number of the pagination"),
     limit: int = Query(10, description="Number of items per page"),
+    fields: Optional[str] = Query(
+        None, description="Comma separated product fields or a preset: card, detail"
+    ),
     current_user: TokenData = Depends(get_current_user),
 ):
+    selected = parse_fields(fields)
     mycursor = mydb.cursor(dictionary=True)
     offset = (page - 1) * limit
-    query = """
-    SELECT ci.quantity, p.product_id, p.category_id, p.name, 
-           p.description, p.price, p.product_image
+    query = f"""
+    SELECT ci.quantity, {", ".join("p." + name for name in selected)}
     FROM cart c
     JOIN cart_items ci ON c.cart_id = ci.cart_id
     JOIN products p ON ci.product_id = p.product_id
@@ -148,14 +193,7 @@ def get_cart(
     cart_items_with_products = [
         {
             "quantity": item["quantity"],
-            "product": {
-                "product_id": item["product_id"],
-                "category_id": item["category_id"],
-                "name": item["name"],
-                "description": item["description"],
-                "price": item["price"],
-                "product_image": item["product_image"],
-            },
+            "product": {name: item[name] for name in selected},
         }
         for item in items
     ]
@@ -180,13 +218,108 @@ def get_cart(
     }
 
 
+# the cart page: the first page of the cart plus the shipping address in one
+# request, read straight from the addresses table instead of a second hop
+# through addresses_backend
+@app.get("/api/cart/get_cart_page", response_model=Dict[str, Any])
+def get_cart_page(
+    user_id: int = Query(...),
+    page: int = Query(1, description="Page number of the pagination"),
+    limit: int = Query(10, description="Number of items per page"),
+    fields: Optional[str] = Query(
+        None, description="Comma separated product fields or a preset: card, detail"
+    ),
+    current_user: TokenData = Depends(get_current_user),
+):
+    cart = get_cart(
+        user_id=user_id, page=page, limit=limit, fields=fields, current_user=current_user
+    )
+    mycursor = mydb.cursor(dictionary=True)
+    mycursor.execute(
+        "SELECT * FROM addresses WHERE user_id = %s AND is_current = True", (user_id,)
+    )
+    address = mycursor.fetchone()
+    if address is not None:
+        address["is_current"] = bool(address["is_current"])
+    return {"cart": cart, "current_address": address}
+
+
 @app.delete("/api/cart/delete_cart_item")
 def delete_cart_item(
     user_id: int,
     product_id: int,
 ):
     mycursor = mydb.cursor()
-    query = "DELETE FROM cart_items WHERE cart_id=%s AND product_id=%s"
-    mycursor.execute(query, (user_id, product_id))
-    mydb.commit()
+    query = """
+    DELETE ci FROM cart_items ci JOIN cart c ON c.cart_id = ci.cart_id
+    WHERE c.user_id = %s AND ci.product_id = %s
+    """
+    try:
+        db.begin(mydb)
+        mycursor.execute(query, (user_id, product_id))
+        mycursor.execute("UPDATE cart SET updated_at = NOW() WHERE user_id = %s", (user_id,))
+        mydb.commit()
+    except Exception:
+        mydb.rollback()
+        raise
     return {"message": "Deleted cart item successfully"}
+
+
+@app.delete("/api/cart/clear_cart")
+def clear_cart(user_id: int, current_user: TokenData = Depends(get_current_user)):
+    mycursor = mydb.cursor()
+    try:
+        db.begin(mydb)
+        mycursor.execute(
+            "DELETE ci FROM cart_items ci JOIN cart c ON c.cart_id = ci.cart_id WHERE c.user_id = %s",
+            (user_id,),
+        )
+        removed = mycursor.rowcount
+        mycursor.execute("UPDATE cart SET updated_at = NOW() WHERE user_id = %s", (user_id,))
+        mydb.commit()
+    except Exception:
+        mydb.rollback()
+        raise
+    return {"message": "Cleared cart successfully", "items_removed": removed}
+
+
+# e.g. a guest session's cart into the account the guest just logged in to;
+# quantities of products in both carts are added up
+@app.post("/api/cart/merge_cart")
+def merge_cart(
+    from_user_id: int,
+    to_user_id: int,
+    current_user: TokenData = Depends(get_current_user),
+):
+    if from_user_id == to_user_id:
+        raise HTTPException(status_code=400, detail="Cannot merge a cart into itself")
+    mycursor = mydb.cursor()
+    try:
+        db.begin(mydb)
+        cart_id = touch_cart(mycursor, to_user_id)
+        mycursor.execute(
+            """
+            INSERT INTO cart_items (cart_id, product_id, quantity)
+            SELECT %s, ci.product_id, ci.quantity
+            FROM cart_items ci JOIN cart c ON c.cart_id = ci.cart_id
+            WHERE c.user_id = %s
+            ON DUPLICATE KEY UPDATE quantity = cart_items.quantity + VALUES(quantity)
+        """,
+            (cart_id, from_user_id),
+        )
+        mycursor.execute(
+            "DELETE ci FROM cart_items ci JOIN cart c ON c.cart_id = ci.cart_id WHERE c.user_id = %s",
+            (from_user_id,),
+        )
+        merged = mycursor.rowcount
+        mycursor.execute("DELETE FROM cart WHERE user_id = %s", (from_user_id,))
+        mydb.commit()
+    except Exception:
+        mydb.rollback()
+        raise
+    return {"message": "Merged cart successfully", "cart_id": cart_id, "items_merged": merged}
+
+
+@app.get("/api/cart/get_sweeper_stats", response_model=Dict[str, Any])
+def get_sweeper_stats(current_user: TokenData = Depends(get_current_user)):
+    return sweeper.get_stats()
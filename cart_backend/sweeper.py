@@ -0,0 +1,137 @@
+"""Removes abandoned carts.
+
+A cart's ``updated_at`` is bumped by every write to it (add, delete, clear,
+merge). Carts idle for more than CART_IDLE_DAYS are deleted together with
+their items, CART_SWEEP_BATCH_SIZE carts per short transaction with a pause
+between batches. With CART_SWEEP_MODE=archive the items are first copied to
+``abandoned_cart_items`` (e.g. for reminder e-mails) instead of just being
+dropped.
+
+Runs as a background thread of the service every CART_SWEEP_INTERVAL_SECONDS,
+or once by hand with
+
+    python sweeper.py
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import db
+
+IDLE_DAYS = int(os.environ.get("CART_IDLE_DAYS", "30"))
+MODE = os.environ.get("CART_SWEEP_MODE", "delete")
+BATCH_SIZE = int(os.environ.get("CART_SWEEP_BATCH_SIZE", "500"))
+BATCH_PAUSE = float(os.environ.get("CART_SWEEP_PAUSE_SECONDS", "0.2"))
+INTERVAL = int(os.environ.get("CART_SWEEP_INTERVAL_SECONDS", "3600"))
+
+stats = {
+    "runs": 0,
+    "carts_removed": 0,
+    "items_removed": 0,
+    "items_archived": 0,
+    "last_run_at": None,
+    "last_run_seconds": None,
+    "last_error": None,
+}
+_stats_lock = threading.Lock()
+
+
+def sweep_batch(conn, cutoff):
+    """Remove up to BATCH_SIZE carts idle since before cutoff.
+
+    Returns (carts, items) removed.
+    """
+    cursor = conn.cursor()
+    try:
+        db.begin(conn)
+        # locking the cart rows makes a concurrent add_to_cart, which bumps
+        # updated_at first, either win (cart no longer idle) or wait and
+        # start a fresh cart
+        cursor.execute(
+            "SELECT cart_id FROM cart WHERE updated_at < %s ORDER BY updated_at LIMIT %s FOR UPDATE",
+            (cutoff, BATCH_SIZE),
+        )
+        cart_ids = tuple(row[0] for row in cursor.fetchall())
+        if not cart_ids:
+            conn.commit()
+            return 0, 0
+        ids = ", ".join(["%s"] * len(cart_ids))
+        archived = 0
+        if MODE == "archive":
+            cursor.execute(
+                f"""
+                INSERT INTO abandoned_cart_items
+                    (cart_id, user_id, product_id, quantity, last_activity)
+                SELECT c.cart_id, c.user_id, ci.product_id, ci.quantity, c.updated_at
+                FROM cart c JOIN cart_items ci ON ci.cart_id = c.cart_id
+                WHERE c.cart_id IN ({ids})
+            """,
+                cart_ids,
+            )
+            archived = cursor.rowcount
+        cursor.execute(f"DELETE FROM cart_items WHERE cart_id IN ({ids})", cart_ids)
+        items = cursor.rowcount
+        cursor.execute(f"DELETE FROM cart WHERE cart_id IN ({ids})", cart_ids)
+        carts = cursor.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    with _stats_lock:
+        stats["carts_removed"] += carts
+        stats["items_removed"] += items
+        stats["items_archived"] += archived
+    return carts, items
+
+
+def sweep_idle_carts(conn):
+    cutoff = datetime.now() - timedelta(days=IDLE_DAYS)
+    started = time.monotonic()
+    total_carts = total_items = 0
+    try:
+        while True:
+            carts, items = sweep_batch(conn, cutoff)
+            total_carts += carts
+            total_items += items
+            if carts < BATCH_SIZE:
+                break
+            time.sleep(BATCH_PAUSE)
+        error = None
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        with _stats_lock:
+            stats["runs"] += 1
+            stats["last_run_at"] = datetime.now().isoformat(timespec="seconds")
+            stats["last_run_seconds"] = round(time.monotonic() - started, 3)
+            stats["last_error"] = error
+    return total_carts, total_items
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(stats, idle_days=IDLE_DAYS, mode=MODE)
+
+
+def _run_sweeper():
+    conn = db.connect()
+    while True:
+        try:
+            if not conn.is_connected():
+                conn.reconnect()
+            sweep_idle_carts(conn)
+        except Exception as e:
+            print(f"cart sweep failed: {e}")
+        time.sleep(INTERVAL)
+
+
+def start_background_sweeper():
+    threading.Thread(target=_run_sweeper, daemon=True).start()
+
+
+if __name__ == "__main__":
+    carts, items = sweep_idle_carts(db.primary)
+    print(f"removed {carts} carts ({items} items)")
@@ -0,0 +1,168 @@
+"""All five backends in one process.
+
+    uvicorn combined:app --host 0.0.0.0 --port 80
+
+Each service's ``main.py`` is loaded unchanged and its FastAPI app is served
+under the same /api/<service> prefix nginx routes to it, so clients do not
+see a difference. A module that several services have (``db``, and so its
+per-thread connections, ``tracing``, ``fastjson``) is loaded once and
+shared; the loader refuses to start if the copies differ. The JWT check
+used by products, cart, orders and addresses is done once per token and
+remembered until the token expires. The storefront in nginx/website is served at "/".
+
+The per-service deployment (docker-compose.yml) is unaffected.
+"""
+
+import contextlib
+import filecmp
+import importlib.util
+import os
+import sys
+import threading
+import time
+
+from fastapi import Security
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from fastapi.staticfiles import StaticFiles
+from jose import jwt, JWTError  # type: ignore
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse, PlainTextResponse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SERVICES = ["auth", "products", "cart", "orders", "addresses"]
+WEBSITE_DIR = os.path.join(ROOT, "nginx", "website")
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", "10000"))
+
+
+_module_files = {}  # "db.py" -> the first service's copy
+
+
+def check_shared_modules(directory):
+    """Fail if a module here differs from another service's copy of it."""
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".py") or filename == "main.py":
+            continue
+        path = os.path.join(directory, filename)
+        first = _module_files.setdefault(filename, path)
+        if first != path and not filecmp.cmp(first, path, shallow=False):
+            raise RuntimeError(
+                f"{path} differs from {first}; services sharing one process"
+                " must have identical copies"
+            )
+
+
+def load_service(name):
+    directory = os.path.join(ROOT, f"{name}_backend")
+    # the service's own modules (db, images, rollups, ...) are imported by
+    # plain name, and Python loads each name only once: a module several
+    # services have (db.py, tracing.py, fastjson.py) comes from whichever
+    # service loads first, so every copy has to be the same
+    check_shared_modules(directory)
+    sys.path.insert(0, directory)
+    spec = importlib.util.spec_from_file_location(
+        f"{name}_main", os.path.join(directory, "main.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+bearer = HTTPBearer()
+_verified = {}  # (secret, token) -> (expires at, username)
+_verified_lock = threading.Lock()
+
+
+def _remember(key, username, expires):
+    with _verified_lock:
+        if len(_verified) >= AUTH_CACHE_SIZE:
+            now = time.time()
+            for stale in [k for k, (exp, _) in _verified.items() if exp <= now]:
+                del _verified[stale]
+            if len(_verified) >= AUTH_CACHE_SIZE:
+                _verified.clear()
+        _verified[key] = (expires, username)
+
+
+def cached_current_user(service):
+    """Drop-in for the service's get_current_user that skips repeat decodes."""
+    verify = service.get_current_user
+
+    def get_current_user(credentials: HTTPAuthorizationCredentials = Security(bearer)):
+        key = (service.SECRET_KEY, credentials.credentials)
+        hit = _verified.get(key)
+        if hit is not None and hit[0] > time.time():
+            return service.TokenData(username=hit[1])
+        user = verify(credentials)
+        try:
+            expires = jwt.get_unverified_claims(credentials.credentials).get("exp")
+        except JWTError:
+            expires = None
+        # tokens without an expiry are checked every time
+        if isinstance(expires, (int, float)):
+            _remember(key, user.username, expires)
+        return user
+
+    return get_current_user
+
+
+class Website(StaticFiles):
+    """The storefront, with nginx's ``try_files $uri $uri/ /index.html``."""
+
+    async def get_response(self, path, scope):
+        try:
+            return await super().get_response(path, scope)
+        except HTTPException as e:
+            if e.status_code == 404:
+                return await super().get_response("index.html", scope)
+            return PlainTextResponse(e.detail, status_code=e.status_code, headers=e.headers)
+
+
+class CombinedApp:
+    """Routes each request by path prefix, without stripping the prefix."""
+
+    def __init__(self, services, website=None):
+        self.routes = [(f"/api/{name}", service.app) for name, service in services.items()]
+        self.website = website
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        path = scope["path"]
+        for prefix, app in self.routes:
+            if path == prefix or path.startswith(prefix + "/"):
+                await app(scope, receive, send)
+                return
+        if self.website is not None:
+            await self.website(scope, receive, send)
+            return
+        if scope["type"] == "http":
+            response = JSONResponse({"detail": "Not Found"}, status_code=404)
+            await response(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        # run every service's startup handlers (background jobs etc.)
+        await receive()
+        async with contextlib.AsyncExitStack() as stack:
+            try:
+                for _, app in self.routes:
+                    await stack.enter_async_context(app.router.lifespan_context(app))
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+            await receive()
+        await send({"type": "lifespan.shutdown.complete"})
+
+
+services = {name: load_service(name) for name in SERVICES}
+for name in ["products", "cart", "orders", "addresses"]:
+    service = services[name]
+    service.app.dependency_overrides[service.get_current_user] = cached_current_user(service)
+
+website = None
+if os.path.isdir(WEBSITE_DIR):
+    website = Website(directory=WEBSITE_DIR, html=True)
+
+app = CombinedApp(services, website)
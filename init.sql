@@ -23,7 +23,8 @@ CREATE TABLE `addresses` (
     `state` varchar(255),
     `zip_code` varchar(255),
     `country` varchar(255),
-    `is_current` boolean
+    `is_current` boolean,
+    KEY `idx_user_current` (`user_id`, `is_current`)
 );
 
 CREATE TABLE `categories` (
@@ -38,19 +39,62 @@ CREATE TABLE `products` (
     `description` text,
     `price` decimal,
     `stock_quantity` int,
-    `product_image` varchar(255)
+    `product_image` varchar(255),
+    KEY `idx_category_price` (`category_id`, `price`),
+    KEY `idx_price` (`price`)
+);
+
+CREATE TABLE `product_sales` (
+    `product_id` int PRIMARY KEY,
+    `category_id` int,
+    `units_sold` int,
+    KEY `idx_category_units_sold` (`category_id`, `units_sold`),
+    KEY `idx_units_sold` (`units_sold`)
+);
+
+CREATE TABLE `stock_shards` (
+    `product_id` int,
+    `shard_no` int,
+    `quantity` int,
+    PRIMARY KEY (`product_id`, `shard_no`)
+);
+
+CREATE TABLE `stock_reservations` (
+    `reservation_id` int PRIMARY KEY AUTO_INCREMENT,
+    `user_id` int,
+    `product_id` int,
+    `shard_no` int,
+    `quantity` int,
+    `status` varchar(255),
+    `expires_at` datetime,
+    KEY `idx_status_expires_at` (`status`, `expires_at`)
 );
 
 CREATE TABLE `cart` (
     `cart_id` int PRIMARY KEY AUTO_INCREMENT,
-    `user_id` int
+    `user_id` int,
+    `updated_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY `uq_user` (`user_id`),
+    KEY `idx_updated_at` (`updated_at`)
 );
 
 CREATE TABLE `cart_items` (
     `cart_item_id` int PRIMARY KEY AUTO_INCREMENT,
     `cart_id` int,
     `product_id` int,
-    `quantity` int
+    `quantity` int,
+    UNIQUE KEY `uq_cart_product` (`cart_id`, `product_id`)
+);
+
+CREATE TABLE `abandoned_cart_items` (
+    `id` int PRIMARY KEY AUTO_INCREMENT,
+    `cart_id` int NOT NULL,
+    `user_id` int,
+    `product_id` int NOT NULL,
+    `quantity` int NOT NULL,
+    `last_activity` datetime NOT NULL,
+    `swept_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    KEY `idx_user` (`user_id`)
 );
 
 CREATE TABLE `orders` (
@@ -59,7 +103,8 @@ CREATE TABLE `orders` (
     `address_id` int,
     `order_date` datetime,
     `status` varchar(255),
-    `total_price` decimal
+    `total_price` decimal,
+    KEY `idx_order_date` (`order_date`)
 );
 
 CREATE TABLE `order_items` (
@@ -70,6 +115,63 @@ CREATE TABLE `order_items` (
     `price_per_unit` decimal
 );
 
+CREATE TABLE `orders_archive` (
+    `order_id` int,
+    `user_id` int,
+    `address_id` int,
+    `order_date` datetime,
+    `status` varchar(255),
+    `total_price` decimal,
+    PRIMARY KEY (`order_id`, `order_date`),
+    KEY `idx_user_id` (`user_id`)
+)
+PARTITION BY RANGE (TO_DAYS(`order_date`)) (
+    PARTITION `p_future` VALUES LESS THAN MAXVALUE
+);
+
+CREATE TABLE `order_items_archive` (
+    `order_item_id` int,
+    `order_id` int,
+    `product_id` int,
+    `quantity` int,
+    `price_per_unit` decimal,
+    `order_date` datetime,
+    PRIMARY KEY (`order_item_id`, `order_date`),
+    KEY `idx_order_id` (`order_id`)
+)
+PARTITION BY RANGE (TO_DAYS(`order_date`)) (
+    PARTITION `p_future` VALUES LESS THAN MAXVALUE
+);
+
+CREATE TABLE `daily_revenue` (
+    `day` date PRIMARY KEY,
+    `orders` int,
+    `revenue` decimal(15, 2)
+);
+
+CREATE TABLE `product_daily_sales` (
+    `day` date,
+    `product_id` int,
+    `units` int,
+    `revenue` decimal(15, 2),
+    PRIMARY KEY (`day`, `product_id`)
+);
+
+CREATE TABLE `order_status_counts` (
+    `status` varchar(255) PRIMARY KEY,
+    `orders` int
+);
+
+CREATE TABLE `user_order_stats` (
+    `user_id` int PRIMARY KEY,
+    `orders` int NOT NULL DEFAULT 0,
+    `total_spent` decimal(15, 2) NOT NULL DEFAULT 0,
+    `first_order_date` datetime,
+    `last_order_id` int,
+    `last_order_date` datetime,
+    `last_order_status` varchar(255)
+);
+
 ALTER TABLE
     `addresses`
 ADD
@@ -80,6 +182,21 @@ ALTER TABLE
 ADD
     FOREIGN KEY (`category_id`) REFERENCES `categories` (`category_id`);
 
+ALTER TABLE
+    `product_sales`
+ADD
+    FOREIGN KEY (`product_id`) REFERENCES `products` (`product_id`);
+
+ALTER TABLE
+    `stock_shards`
+ADD
+    FOREIGN KEY (`product_id`) REFERENCES `products` (`product_id`);
+
+ALTER TABLE
+    `stock_reservations`
+ADD
+    FOREIGN KEY (`product_id`) REFERENCES `products` (`product_id`);
+
 ALTER TABLE
     `cart`
 ADD
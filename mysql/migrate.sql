@@ -0,0 +1,243 @@
+-- Brings a database created from an older init.sql up to the current schema.
+-- init.sql only runs on an empty data directory; run this against an
+-- existing mysql_data volume instead. Safe to run more than once:
+--
+--     docker compose exec -T mysql mysql -uuser -ppassword flowerstore < mysql/migrate.sql
+--
+-- Then fill the sales rollups from the existing orders (orders_backend):
+--
+--     python rollups.py backfill
+
+USE `flowerstore`;
+
+DROP PROCEDURE IF EXISTS `migrate_run`;
+DROP PROCEDURE IF EXISTS `migrate_column`;
+DROP PROCEDURE IF EXISTS `migrate_index`;
+DROP PROCEDURE IF EXISTS `migrate_foreign_key`;
+DROP PROCEDURE IF EXISTS `migrate_cart_unique_keys`;
+
+DELIMITER //
+
+CREATE PROCEDURE `migrate_run`(ddl TEXT)
+BEGIN
+    SET @migrate_statement = ddl;
+    PREPARE migrate_stmt FROM @migrate_statement;
+    EXECUTE migrate_stmt;
+    DEALLOCATE PREPARE migrate_stmt;
+END //
+
+CREATE PROCEDURE `migrate_column`(tbl VARCHAR(64), col VARCHAR(64), ddl TEXT)
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = tbl AND COLUMN_NAME = col
+    ) THEN
+        CALL migrate_run(ddl);
+    END IF;
+END //
+
+CREATE PROCEDURE `migrate_index`(tbl VARCHAR(64), idx VARCHAR(64), ddl TEXT)
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = tbl AND INDEX_NAME = idx
+    ) THEN
+        CALL migrate_run(ddl);
+    END IF;
+END //
+
+CREATE PROCEDURE `migrate_foreign_key`(tbl VARCHAR(64), col VARCHAR(64), ref VARCHAR(64))
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.KEY_COLUMN_USAGE
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = tbl AND COLUMN_NAME = col
+          AND REFERENCED_TABLE_NAME = ref
+    ) THEN
+        CALL migrate_run(CONCAT(
+            'ALTER TABLE `', tbl, '` ADD FOREIGN KEY (`', col, '`) REFERENCES `',
+            ref, '` (`', col, '`)'
+        ));
+    END IF;
+END //
+
+-- one cart per user and one row per product in a cart: older code could
+-- create duplicates, which are merged before the unique keys go on
+CREATE PROCEDURE `migrate_cart_unique_keys`()
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'cart' AND INDEX_NAME = 'uq_user'
+    ) THEN
+        DROP TEMPORARY TABLE IF EXISTS `migrate_cart_keep`;
+        CREATE TEMPORARY TABLE `migrate_cart_keep` AS
+            SELECT c.cart_id, k.keep_id
+            FROM cart c
+            JOIN (
+                SELECT user_id, MIN(cart_id) AS keep_id FROM cart
+                WHERE user_id IS NOT NULL
+                GROUP BY user_id HAVING COUNT(*) > 1
+            ) k ON k.user_id = c.user_id
+            WHERE c.cart_id <> k.keep_id;
+        UPDATE cart_items ci JOIN migrate_cart_keep m ON m.cart_id = ci.cart_id
+        SET ci.cart_id = m.keep_id;
+        DELETE c FROM cart c JOIN migrate_cart_keep m ON m.cart_id = c.cart_id;
+        DROP TEMPORARY TABLE `migrate_cart_keep`;
+        ALTER TABLE `cart` ADD UNIQUE KEY `uq_user` (`user_id`);
+    END IF;
+
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'cart_items'
+          AND INDEX_NAME = 'uq_cart_product'
+    ) THEN
+        DROP TEMPORARY TABLE IF EXISTS `migrate_cart_item_keep`;
+        CREATE TEMPORARY TABLE `migrate_cart_item_keep` AS
+            SELECT cart_id, product_id, MIN(cart_item_id) AS keep_id, SUM(quantity) AS quantity
+            FROM cart_items
+            GROUP BY cart_id, product_id HAVING COUNT(*) > 1;
+        UPDATE cart_items ci JOIN migrate_cart_item_keep m ON m.keep_id = ci.cart_item_id
+        SET ci.quantity = m.quantity;
+        DELETE ci FROM cart_items ci
+        JOIN migrate_cart_item_keep m
+            ON m.cart_id = ci.cart_id AND m.product_id = ci.product_id
+        WHERE ci.cart_item_id <> m.keep_id;
+        DROP TEMPORARY TABLE `migrate_cart_item_keep`;
+        ALTER TABLE `cart_items` ADD UNIQUE KEY `uq_cart_product` (`cart_id`, `product_id`);
+    END IF;
+END //
+
+DELIMITER ;
+
+CALL migrate_index('addresses', 'idx_user_current',
+    'ALTER TABLE `addresses` ADD KEY `idx_user_current` (`user_id`, `is_current`)');
+
+CALL migrate_index('products', 'idx_category_price',
+    'ALTER TABLE `products` ADD KEY `idx_category_price` (`category_id`, `price`)');
+CALL migrate_index('products', 'idx_price',
+    'ALTER TABLE `products` ADD KEY `idx_price` (`price`)');
+
+CREATE TABLE IF NOT EXISTS `product_sales` (
+    `product_id` int PRIMARY KEY,
+    `category_id` int,
+    `units_sold` int,
+    KEY `idx_category_units_sold` (`category_id`, `units_sold`),
+    KEY `idx_units_sold` (`units_sold`)
+);
+
+CREATE TABLE IF NOT EXISTS `stock_shards` (
+    `product_id` int,
+    `shard_no` int,
+    `quantity` int,
+    PRIMARY KEY (`product_id`, `shard_no`)
+);
+
+CREATE TABLE IF NOT EXISTS `stock_reservations` (
+    `reservation_id` int PRIMARY KEY AUTO_INCREMENT,
+    `user_id` int,
+    `product_id` int,
+    `shard_no` int,
+    `quantity` int,
+    `status` varchar(255),
+    `expires_at` datetime,
+    KEY `idx_status_expires_at` (`status`, `expires_at`)
+);
+
+CALL migrate_column('cart', 'updated_at',
+    'ALTER TABLE `cart` ADD COLUMN `updated_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP');
+CALL migrate_index('cart', 'idx_updated_at',
+    'ALTER TABLE `cart` ADD KEY `idx_updated_at` (`updated_at`)');
+CALL migrate_cart_unique_keys();
+
+CREATE TABLE IF NOT EXISTS `abandoned_cart_items` (
+    `id` int PRIMARY KEY AUTO_INCREMENT,
+    `cart_id` int NOT NULL,
+    `user_id` int,
+    `product_id` int NOT NULL,
+    `quantity` int NOT NULL,
+    `last_activity` datetime NOT NULL,
+    `swept_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    KEY `idx_user` (`user_id`)
+);
+
+CALL migrate_index('orders', 'idx_order_date',
+    'ALTER TABLE `orders` ADD KEY `idx_order_date` (`order_date`)');
+
+CREATE TABLE IF NOT EXISTS `orders_archive` (
+    `order_id` int,
+    `user_id` int,
+    `address_id` int,
+    `order_date` datetime,
+    `status` varchar(255),
+    `total_price` decimal,
+    PRIMARY KEY (`order_id`, `order_date`),
+    KEY `idx_user_id` (`user_id`)
+)
+PARTITION BY RANGE (TO_DAYS(`order_date`)) (
+    PARTITION `p_future` VALUES LESS THAN MAXVALUE
+);
+
+CREATE TABLE IF NOT EXISTS `order_items_archive` (
+    `order_item_id` int,
+    `order_id` int,
+    `product_id` int,
+    `quantity` int,
+    `price_per_unit` decimal,
+    `order_date` datetime,
+    PRIMARY KEY (`order_item_id`, `order_date`),
+    KEY `idx_order_id` (`order_id`)
+)
+PARTITION BY RANGE (TO_DAYS(`order_date`)) (
+    PARTITION `p_future` VALUES LESS THAN MAXVALUE
+);
+
+CREATE TABLE IF NOT EXISTS `daily_revenue` (
+    `day` date PRIMARY KEY,
+    `orders` int,
+    `revenue` decimal(15, 2)
+);
+
+CREATE TABLE IF NOT EXISTS `product_daily_sales` (
+    `day` date,
+    `product_id` int,
+    `units` int,
+    `revenue` decimal(15, 2),
+    PRIMARY KEY (`day`, `product_id`)
+);
+
+CREATE TABLE IF NOT EXISTS `order_status_counts` (
+    `status` varchar(255) PRIMARY KEY,
+    `orders` int
+);
+
+CREATE TABLE IF NOT EXISTS `user_order_stats` (
+    `user_id` int PRIMARY KEY,
+    `orders` int NOT NULL DEFAULT 0,
+    `total_spent` decimal(15, 2) NOT NULL DEFAULT 0,
+    `first_order_date` datetime,
+    `last_order_id` int,
+    `last_order_date` datetime,
+    `last_order_status` varchar(255)
+);
+
+CALL migrate_foreign_key('product_sales', 'product_id', 'products');
+CALL migrate_foreign_key('stock_shards', 'product_id', 'products');
+CALL migrate_foreign_key('stock_reservations', 'product_id', 'products');
+
+-- products added before product_sales existed; same query as sales.refresh
+INSERT INTO product_sales (product_id, category_id, units_sold)
+SELECT p.product_id, p.category_id, COALESCE(SUM(oi.quantity), 0)
+FROM products p
+LEFT JOIN (
+    SELECT product_id, quantity FROM order_items
+    UNION ALL
+    SELECT product_id, quantity FROM order_items_archive
+) oi ON oi.product_id = p.product_id
+GROUP BY p.product_id, p.category_id
+ON DUPLICATE KEY UPDATE
+    category_id = VALUES(category_id), units_sold = VALUES(units_sold);
+
+DROP PROCEDURE `migrate_run`;
+DROP PROCEDURE `migrate_column`;
+DROP PROCEDURE `migrate_index`;
+DROP PROCEDURE `migrate_foreign_key`;
+DROP PROCEDURE `migrate_cart_unique_keys`;
@@ -0,0 +1,28 @@
+#!/bin/bash
+# Runs once, from docker-entrypoint-initdb.d of the replica container: seeds
+# the replica from a dump of the primary and starts replicating from the
+# binlog position recorded in that dump.
+set -e
+
+primary=(mysql -h"$PRIMARY_HOST" -uroot -p"$PRIMARY_ROOT_PASSWORD")
+local=(mysql --protocol=socket -uroot -p"$MYSQL_ROOT_PASSWORD")
+
+until mysqladmin ping -h"$PRIMARY_HOST" -uroot -p"$PRIMARY_ROOT_PASSWORD" --silent; do
+    sleep 2
+done
+
+"${primary[@]}" -e "
+    CREATE USER IF NOT EXISTS 'repl'@'%' IDENTIFIED BY 'repl';
+    GRANT REPLICATION SLAVE ON *.* TO 'repl'@'%';
+"
+
+mysqldump -h"$PRIMARY_HOST" -uroot -p"$PRIMARY_ROOT_PASSWORD" \
+    --databases "$MYSQL_DATABASE" --single-transaction --master-data=1 \
+    | "${local[@]}"
+
+# the services' lag check runs SHOW SLAVE STATUS as the application user
+"${local[@]}" -e "
+    GRANT REPLICATION CLIENT ON *.* TO '$MYSQL_USER'@'%';
+    CHANGE MASTER TO MASTER_HOST='$PRIMARY_HOST', MASTER_USER='repl', MASTER_PASSWORD='repl';
+    START SLAVE;
+"
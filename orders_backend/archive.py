@@ -0,0 +1,165 @@
+"""Moves old, finished orders out of the hot tables.
+
+Orders older than ARCHIVE_AFTER_DAYS whose status is one of
+ARCHIVE_STATUSES are copied into ``orders_archive`` / ``order_items_archive``
+(range partitioned by month of order_date) and deleted from ``orders`` /
+``order_items``. Each batch of ARCHIVE_BATCH_SIZE orders is its own short
+transaction, with a pause between batches, so the hot tables are never
+locked for long. The read endpoints merge the archive back in when called
+with include_archived=true.
+
+Runs as a background thread of the service every ARCHIVE_INTERVAL_SECONDS,
+or once by hand with
+
+    python archive.py
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import db
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_STATUSES = [
+    status.strip()
+    for status in os.environ.get("ARCHIVE_STATUSES", "delivered,completed,cancelled").split(",")
+    if status.strip()
+]
+BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "500"))
+BATCH_PAUSE = float(os.environ.get("ARCHIVE_BATCH_PAUSE_SECONDS", "0.5"))
+INTERVAL = int(os.environ.get("ARCHIVE_INTERVAL_SECONDS", "3600"))
+
+ARCHIVE_TABLES = ["orders_archive", "order_items_archive"]
+
+
+def _month_partition(month):
+    return f"p{month:%Y%m}"
+
+
+def _next_month(month):
+    return (month.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def ensure_partitions(cursor, newest_order_date):
+    """Split p_future so every month up to newest_order_date has a partition.
+
+    Months are only ever added after the newest existing one; older rows
+    fall into the first partition, whose range is open at the bottom.
+    """
+    month = newest_order_date.date().replace(day=1)
+    for table in ARCHIVE_TABLES:
+        cursor.execute(
+            """
+            SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        """,
+            (table,),
+        )
+        existing = sorted(
+            row[0] for row in cursor.fetchall() if row[0] and row[0] != "p_future"
+        )
+        if existing:
+            latest = datetime.strptime(existing[-1], "p%Y%m").date()
+            start = _next_month(latest)
+        else:
+            start = month
+        new = []
+        while start <= month:
+            new.append(
+                f"PARTITION {_month_partition(start)} VALUES LESS THAN"
+                f" (TO_DAYS('{_next_month(start).isoformat()}'))"
+            )
+            start = _next_month(start)
+        if new:
+            cursor.execute(
+                f"ALTER TABLE {table} REORGANIZE PARTITION p_future INTO"
+                f" ({', '.join(new)}, PARTITION p_future VALUES LESS THAN MAXVALUE)"
+            )
+
+
+def archive_batch(conn, cutoff):
+    """Archive up to BATCH_SIZE orders older than cutoff. Returns how many."""
+    cursor = conn.cursor()
+    statuses = ", ".join(["%s"] * len(ARCHIVE_STATUSES))
+    candidates = f"""
+        SELECT order_id, order_date FROM orders
+        WHERE order_date < %s AND status IN ({statuses})
+        ORDER BY order_date LIMIT %s
+    """
+    params = (cutoff, *ARCHIVE_STATUSES, BATCH_SIZE)
+    cursor.execute(candidates, params)
+    rows = cursor.fetchall()
+    conn.commit()
+    if not rows:
+        return 0
+    # ALTER TABLE commits implicitly, so it has to run before the move
+    ensure_partitions(cursor, max(row[1] for row in rows))
+
+    try:
+        db.begin(conn)
+        cursor.execute(candidates + " FOR UPDATE", params)
+        order_ids = tuple(row[0] for row in cursor.fetchall())
+        if not order_ids:
+            conn.commit()
+            return 0
+        ids = ", ".join(["%s"] * len(order_ids))
+        cursor.execute(
+            f"""
+            INSERT INTO order_items_archive
+                (order_item_id, order_id, product_id, quantity, price_per_unit, order_date)
+            SELECT oi.order_item_id, oi.order_id, oi.product_id, oi.quantity,
+                   oi.price_per_unit, o.order_date
+            FROM order_items oi JOIN orders o ON o.order_id = oi.order_id
+            WHERE oi.order_id IN ({ids})
+        """,
+            order_ids,
+        )
+        cursor.execute(
+            f"""
+            INSERT INTO orders_archive
+                (order_id, user_id, address_id, order_date, status, total_price)
+            SELECT order_id, user_id, address_id, order_date, status, total_price
+            FROM orders WHERE order_id IN ({ids})
+        """,
+            order_ids,
+        )
+        cursor.execute(f"DELETE FROM order_items WHERE order_id IN ({ids})", order_ids)
+        cursor.execute(f"DELETE FROM orders WHERE order_id IN ({ids})", order_ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(order_ids)
+
+
+def archive_old_orders(conn):
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    total = 0
+    while True:
+        moved = archive_batch(conn, cutoff)
+        total += moved
+        if moved < BATCH_SIZE:
+            return total
+        time.sleep(BATCH_PAUSE)
+
+
+def _run_archiver():
+    conn = db.connect()
+    while True:
+        try:
+            if not conn.is_connected():
+                conn.reconnect()
+            archive_old_orders(conn)
+        except Exception as e:
+            print(f"order archiving failed: {e}")
+        time.sleep(INTERVAL)
+
+
+def start_background_archiver():
+    threading.Thread(target=_run_archiver, daemon=True).start()
+
+
+if __name__ == "__main__":
+    print(f"archived {archive_old_orders(db.primary)} orders")
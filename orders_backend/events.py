@@ -0,0 +1,67 @@
+"""In-process broker for order status events.
+
+edit_order_status and add_order publish to it from the (threaded) request
+handlers; the streaming endpoint subscribes per user from the event loop.
+The last EVENT_HISTORY events are kept so a client reconnecting with
+Last-Event-ID gets what it missed. Event ids carry a per-process prefix:
+an id from before a restart cannot be resumed from, and the subscriber is
+told to resync (reload its orders once) instead.
+"""
+
+import asyncio
+import itertools
+import os
+import threading
+import uuid
+from collections import deque
+
+EVENT_HISTORY = int(os.environ.get("ORDER_EVENT_HISTORY", "1000"))
+
+
+class OrderEventBroker:
+    def __init__(self, history=EVENT_HISTORY):
+        self._lock = threading.Lock()
+        self._epoch = uuid.uuid4().hex[:8]
+        self._sequence = itertools.count(1)
+        self._history = deque(maxlen=history)
+        self._subscribers = {}  # user_id -> {(loop, queue)}
+
+    def publish(self, user_id, data):
+        with self._lock:
+            event = (f"{self._epoch}-{next(self._sequence)}", user_id, data)
+            self._history.append(event)
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    def subscribe(self, user_id, last_event_id=None):
+        """Returns (subscription, missed events, whether to resync)."""
+        subscription = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+            missed, resync = self._since(user_id, last_event_id)
+        return subscription, missed, resync
+
+    def _since(self, user_id, last_event_id):
+        if not last_event_id:
+            return [], False
+        epoch, _, sequence = last_event_id.partition("-")
+        oldest = int(self._history[0][0].partition("-")[2]) if self._history else 1
+        if epoch != self._epoch or not sequence.isdigit() or int(sequence) < oldest - 1:
+            return [], True
+        return [
+            event
+            for event in self._history
+            if event[1] == user_id and int(event[0].partition("-")[2]) > int(sequence)
+        ], False
+
+    def unsubscribe(self, user_id, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+
+broker = OrderEventBroker()
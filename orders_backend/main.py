@@ -1,17 +1,20 @@
 from typing import List, Optional
-from fastapi import Depends, FastAPI, HTTPException, Query
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from pydantic import BaseModel
-import mysql.connector
 from jose import jwt, JWTError
+import db
+import tracing
+import fastjson
+import rollups
+import archive
+from events import broker
 
 app = FastAPI(docs_url="/api/orders/docs", openapi_url="/api/orders/openapi.json")
 
-# Database connection
-mydb = mysql.connector.connect(
-    host="mysql", user="user", password="password", database="flowerstore"
-)
-mycursor = mydb.cursor(dictionary=True)
+# Database connection; order history reads may go to a replica (see db.py)
+mydb = db.primary
 
 # Security setup
 SECRET_KEY = "florist"
@@ -29,6 +32,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(tracing.TraceMiddleware, service="orders")
 
 
 # Data models
@@ -61,6 +65,8 @@ class Order(BaseModel):
     status: str
     total_price: float
     order_items: List[OrderItem]
+    # stock held through /api/products/reserve_stock for this checkout
+    reservation_ids: List[int] = []
 
 
 class OrderResponse(Order):
@@ -129,6 +135,58 @@ def fetch_order_details(cursor, order_id):
     )
 
 
+def fetch_orders(cursor, where, params, archived=False):
+    """Orders matching `where` with their items, in two queries.
+
+    `where` is applied to the orders table aliased as ``o``. Built as plain
+    dicts in the OrderResponse shape, for fastjson.
+    """
+    orders_table = "orders_archive" if archived else "orders"
+    items_table = "order_items_archive" if archived else "order_items"
+    cursor.execute(f"SELECT o.* FROM {orders_table} o WHERE {where}", params)
+    orders = cursor.fetchall()
+    if not orders:
+        return []
+    # same filter through a join rather than a list of ids, which would grow
+    # with the table past max_allowed_packet
+    cursor.execute(
+        f"""
+        SELECT i.order_item_id, i.order_id, i.product_id, i.quantity, i.price_per_unit
+        FROM {items_table} i JOIN {orders_table} o ON o.order_id = i.order_id
+        WHERE {where}
+    """,
+        params,
+    )
+    items = {}
+    for item in cursor.fetchall():
+        items.setdefault(item["order_id"], []).append(
+            {
+                "product_id": item["product_id"],
+                "quantity": item["quantity"],
+                "price_per_unit": float(item["price_per_unit"]),
+                "order_item_id": item["order_item_id"],
+            }
+        )
+    return [
+        {
+            "user_id": order["user_id"],
+            "address_id": order["address_id"],
+            "order_date": order["order_date"].strftime("%Y-%m-%d %H:%M:%S"),
+            "status": order["status"],
+            "total_price": float(order["total_price"]),
+            "order_items": items.get(order["order_id"], []),
+            "reservation_ids": [],
+            "order_id": order["order_id"],
+        }
+        for order in orders
+    ]
+
+
+@app.on_event("startup")
+def start_archiver():
+    archive.start_background_archiver()
+
+
 # Endpoints
 @app.post(
     "/api/orders/add_order",
@@ -137,50 +195,89 @@ def fetch_order_details(cursor, order_id):
 )
 def add_order(order: Order, current_user: TokenData = Depends(get_current_user)):
     cursor = mydb.cursor(dictionary=True)
-    cursor.execute(
-        """
-        INSERT INTO orders (user_id, address_id, order_date, status, total_price) VALUES (%s, %s, %s, %s, %s)
-    """,
-        (
-            order.user_id,
-            order.address_id,
-            order.order_date,
-            order.status,
-            order.total_price,
-        ),
-    )
-    order_id = cursor.lastrowid
-    for item in order.order_items:
+    try:
+        db.begin(mydb)
+        if order.reservation_ids:
+            reservation_ids = set(order.reservation_ids)
+            product_ids = {item.product_id for item in order.order_items}
+            # only the ordering user's reservations for products in this order
+            cursor.execute(
+                f"""
+                UPDATE stock_reservations SET status = 'confirmed'
+                WHERE reservation_id IN ({", ".join(["%s"] * len(reservation_ids))})
+                  AND user_id = %s
+                  AND product_id IN ({", ".join(["%s"] * len(product_ids)) or "NULL"})
+                  AND status = 'held' AND expires_at > NOW()
+            """,
+                (*reservation_ids, order.user_id, *product_ids),
+            )
+            if cursor.rowcount != len(reservation_ids):
+                raise HTTPException(
+                    status_code=409, detail="Stock reservation expired or not found"
+                )
         cursor.execute(
             """
-            INSERT INTO order_items (order_id, product_id, quantity, price_per_unit) VALUES (%s, %s, %s, %s)
+            INSERT INTO orders (user_id, address_id, order_date, status, total_price) VALUES (%s, %s, %s, %s, %s)
         """,
-            (order_id, item.product_id, item.quantity, item.price_per_unit),
+            (
+                order.user_id,
+                order.address_id,
+                order.order_date,
+                order.status,
+                order.total_price,
+            ),
         )
-    mydb.commit()
+        order_id = cursor.lastrowid
+        for item in order.order_items:
+            cursor.execute(
+                """
+                INSERT INTO order_items (order_id, product_id, quantity, price_per_unit) VALUES (%s, %s, %s, %s)
+            """,
+                (order_id, item.product_id, item.quantity, item.price_per_unit),
+            )
+        rollups.record_order(cursor, order, order_id)
+        mydb.commit()
+    except Exception:
+        mydb.rollback()
+        raise
+    db.note_write(order.user_id)
+    broker.publish(
+        order.user_id,
+        {"order_id": order_id, "status": order.status, "previous_status": None},
+    )
+    # read back on the primary cursor so the new order is always visible
     return fetch_order_details(cursor, order_id)
 
 
 @app.get("/api/orders/get_orders_all", response_model=List[OrderResponse])
-def get_orders_all(current_user: TokenData = Depends(get_current_user)):
-    cursor = mydb.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM orders")
-    orders = [
-        fetch_order_details(cursor, order["order_id"]) for order in cursor.fetchall()
-    ]
-    return orders
+def get_orders_all(
+    include_archived: bool = False,
+    current_user: TokenData = Depends(get_current_user),
+):
+    cursor = db.reader().cursor(dictionary=True)
+    orders = fetch_orders(cursor, "TRUE", ())
+    if include_archived:
+        orders = sorted(
+            fetch_orders(cursor, "TRUE", (), archived=True) + orders,
+            key=lambda order: order["order_id"],
+        )
+    return fastjson.response(orders)
 
 
 @app.get("/api/orders/get_order_by_user_id", response_model=List[OrderResponse])
 def get_order_by_user_id(
-    user_id: int, current_user: TokenData = Depends(get_current_user)
+    user_id: int,
+    include_archived: bool = False,
+    current_user: TokenData = Depends(get_current_user),
 ):
-    cursor = mydb.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM orders WHERE user_id = %s", (user_id,))
-    orders = [
-        fetch_order_details(cursor, order["order_id"]) for order in cursor.fetchall()
-    ]
-    return orders
+    cursor = db.reader(user_id).cursor(dictionary=True)
+    orders = fetch_orders(cursor, "o.user_id = %s", (user_id,))
+    if include_archived:
+        orders = sorted(
+            fetch_orders(cursor, "o.user_id = %s", (user_id,), archived=True) + orders,
+            key=lambda order: order["order_id"],
+        )
+    return fastjson.response(orders)
 
 
 @app.put("/api/orders/edit_order_status", response_model=OrderResponse)
@@ -188,8 +285,174 @@ def edit_order_status(
     order_id: int, status: str, current_user: TokenData = Depends(get_current_user)
 ):
     cursor = mydb.cursor(dictionary=True)
+    try:
+        db.begin(mydb)
+        cursor.execute(
+            "SELECT order_id, user_id, order_date, status, total_price FROM orders"
+            " WHERE order_id = %s FOR UPDATE",
+            (order_id,),
+        )
+        current = cursor.fetchone()
+        if current is None:
+            raise HTTPException(status_code=404, detail="Order not found")
+        cursor.execute(
+            "UPDATE orders SET status = %s WHERE order_id = %s", (status, order_id)
+        )
+        rollups.record_status_change(cursor, current["status"], status)
+        rollups.record_sales_status_change(cursor, current, status)
+        rollups.record_user_status_change(cursor, current, status)
+        mydb.commit()
+    except Exception:
+        mydb.rollback()
+        raise
+    order = fetch_order_details(cursor, order_id)
+    db.note_write(order.user_id)
+    if current["status"] != status:
+        broker.publish(
+            order.user_id,
+            {
+                "order_id": order_id,
+                "status": status,
+                "previous_status": current["status"],
+            },
+        )
+    return order
+
+
+# Server-Sent Events stream of a user's order status changes, replacing
+# polling get_order_by_user_id. Reconnecting clients send Last-Event-ID and
+# get the events they missed; a "resync" event means they have to reload.
+import asyncio
+import json
+
+KEEPALIVE_SECONDS = 15
+
+
+def format_event(event):
+    event_id, _, data = event
+    return f"id: {event_id}\nevent: order_status\ndata: {json.dumps(data)}\n\n"
+
+
+@app.get("/api/orders/stream_order_status")
+async def stream_order_status(
+    request: Request,
+    user_id: int,
+    last_event_id: Optional[str] = Header(None),
+    current_user: TokenData = Depends(get_current_user),
+):
+    async def stream():
+        subscription, missed, resync = broker.subscribe(user_id, last_event_id)
+        queue = subscription[1]
+        try:
+            if resync:
+                yield "event: resync\ndata: {}\n\n"
+            for event in missed:
+                yield format_event(event)
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_event(event)
+        finally:
+            broker.unsubscribe(user_id, subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Dashboard endpoints, served from the rollup tables kept by rollups.py
+from datetime import date
+
+
+@app.get("/api/orders/get_daily_revenue")
+def get_daily_revenue(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    current_user: TokenData = Depends(get_current_user),
+):
+    cursor = db.reader().cursor(dictionary=True)
     cursor.execute(
-        "UPDATE orders SET status = %s WHERE order_id = %s", (status, order_id)
+        """
+        SELECT day, orders, revenue FROM daily_revenue
+        WHERE day >= COALESCE(%s, '1000-01-01') AND day <= COALESCE(%s, '9999-12-31')
+        ORDER BY day
+    """,
+        (start, end),
     )
-    mydb.commit()
-    return fetch_order_details(cursor, order_id)
+    return [
+        {
+            "day": row["day"].isoformat(),
+            "orders": row["orders"],
+            "revenue": float(row["revenue"]),
+        }
+        for row in cursor.fetchall()
+    ]
+
+
+@app.get("/api/orders/get_top_products")
+def get_top_products(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    limit: int = Query(10, ge=1, le=100),
+    current_user: TokenData = Depends(get_current_user),
+):
+    cursor = db.reader().cursor(dictionary=True)
+    cursor.execute(
+        """
+        SELECT product_id, SUM(units) AS units, SUM(revenue) AS revenue
+        FROM product_daily_sales
+        WHERE day >= COALESCE(%s, '1000-01-01') AND day <= COALESCE(%s, '9999-12-31')
+        GROUP BY product_id ORDER BY units DESC LIMIT %s
+    """,
+        (start, end, limit),
+    )
+    return [
+        {
+            "product_id": row["product_id"],
+            "units": int(row["units"]),
+            "revenue": float(row["revenue"]),
+        }
+        for row in cursor.fetchall()
+    ]
+
+
+@app.get("/api/orders/get_status_counts")
+def get_status_counts(current_user: TokenData = Depends(get_current_user)):
+    cursor = db.reader().cursor(dictionary=True)
+    cursor.execute("SELECT status, orders FROM order_status_counts WHERE orders > 0")
+    return {row["status"]: row["orders"] for row in cursor.fetchall()}
+
+
+# account page: order count, spend and last order from one user_order_stats
+# row instead of loading the whole order history
+@app.get("/api/orders/summary")
+def get_order_summary(
+    user_id: int, current_user: TokenData = Depends(get_current_user)
+):
+    cursor = db.reader(user_id).cursor(dictionary=True)
+    cursor.execute("SELECT * FROM user_order_stats WHERE user_id = %s", (user_id,))
+    stats = cursor.fetchone()
+    if stats is None:
+        return {
+            "user_id": user_id,
+            "orders": 0,
+            "total_spent": 0.0,
+            "first_order_date": None,
+            "last_order": None,
+        }
+    return {
+        "user_id": user_id,
+        "orders": stats["orders"],
+        "total_spent": float(stats["total_spent"]),
+        "first_order_date": stats["first_order_date"].strftime("%Y-%m-%d %H:%M:%S"),
+        "last_order": {
+            "order_id": stats["last_order_id"],
+            "order_date": stats["last_order_date"].strftime("%Y-%m-%d %H:%M:%S"),
+            "status": stats["last_order_status"],
+        },
+    }
@@ -0,0 +1,258 @@
+"""Sales rollups for the admin dashboard and the account page.
+
+``daily_revenue``, ``product_daily_sales``, ``order_status_counts`` and
+``user_order_stats`` (one row per customer: order count, spend, last order)
+are kept up to date inside the same transaction as add_order and
+edit_order_status, so dashboard queries read a few hundred rollup rows and
+the account summary one row instead of scanning orders. They can be rebuilt
+from scratch with
+
+    python rollups.py backfill
+"""
+
+import sys
+
+import db
+
+# orders in this status still count as orders, but not towards revenue,
+# units sold or a customer's spend
+CANCELLED = "cancelled"
+
+
+def record_order(cursor, order, order_id):
+    cancelled = order.status == CANCELLED
+    cursor.execute(
+        """
+        INSERT INTO daily_revenue (day, orders, revenue) VALUES (DATE(%s), 1, %s)
+        ON DUPLICATE KEY UPDATE orders = orders + 1, revenue = revenue + VALUES(revenue)
+    """,
+        (order.order_date, 0 if cancelled else order.total_price),
+    )
+    for item in [] if cancelled else order.order_items:
+        cursor.execute(
+            """
+            INSERT INTO product_daily_sales (day, product_id, units, revenue)
+            VALUES (DATE(%s), %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                units = units + VALUES(units), revenue = revenue + VALUES(revenue)
+        """,
+            (
+                order.order_date,
+                item.product_id,
+                item.quantity,
+                item.quantity * item.price_per_unit,
+            ),
+        )
+    record_status_change(cursor, None, order.status)
+    # the IF()s see the row as updated so far, hence status and id are set
+    # before the date they compare against
+    cursor.execute(
+        """
+        INSERT INTO user_order_stats
+            (user_id, orders, total_spent, first_order_date,
+             last_order_id, last_order_date, last_order_status)
+        VALUES (%s, 1, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            orders = orders + 1,
+            total_spent = total_spent + VALUES(total_spent),
+            first_order_date = LEAST(first_order_date, VALUES(first_order_date)),
+            last_order_status = IF(
+                (VALUES(last_order_date), VALUES(last_order_id)) >= (last_order_date, last_order_id),
+                VALUES(last_order_status), last_order_status),
+            last_order_id = IF(
+                (VALUES(last_order_date), VALUES(last_order_id)) >= (last_order_date, last_order_id),
+                VALUES(last_order_id), last_order_id),
+            last_order_date = GREATEST(last_order_date, VALUES(last_order_date))
+    """,
+        (
+            order.user_id,
+            0 if order.status == CANCELLED else order.total_price,
+            order.order_date,
+            order_id,
+            order.order_date,
+            order.status,
+        ),
+    )
+
+
+def _cancellation_sign(old_status, new_status):
+    """-1 when an order gets cancelled, 1 when it stops being cancelled."""
+    if old_status == new_status:
+        return 0
+    if new_status == CANCELLED:
+        return -1
+    if old_status == CANCELLED:
+        return 1
+    return 0
+
+
+def record_sales_status_change(cursor, order, new_status):
+    """Take a cancelled order out of revenue and units sold, or put it back.
+
+    order: the row being changed (order_id, order_date, status, total_price).
+    """
+    sign = _cancellation_sign(order["status"], new_status)
+    if not sign:
+        return
+    cursor.execute(
+        """
+        INSERT INTO daily_revenue (day, orders, revenue) VALUES (DATE(%s), 0, %s)
+        ON DUPLICATE KEY UPDATE revenue = revenue + VALUES(revenue)
+    """,
+        (order["order_date"], sign * order["total_price"]),
+    )
+    cursor.execute(
+        """
+        INSERT INTO product_daily_sales (day, product_id, units, revenue)
+        SELECT DATE(%s), product_id, %s * SUM(quantity), %s * SUM(quantity * price_per_unit)
+        FROM order_items WHERE order_id = %s
+        GROUP BY product_id
+        ON DUPLICATE KEY UPDATE
+            units = units + VALUES(units), revenue = revenue + VALUES(revenue)
+    """,
+        (order["order_date"], sign, sign, order["order_id"]),
+    )
+
+
+def record_user_status_change(cursor, order, new_status):
+    """order: the row being changed (order_id, user_id, status, total_price)."""
+    old_status = order["status"]
+    if old_status == new_status:
+        return
+    spent = _cancellation_sign(old_status, new_status) * order["total_price"]
+    cursor.execute(
+        """
+        UPDATE user_order_stats
+        SET total_spent = total_spent + %s,
+            last_order_status = IF(last_order_id = %s, %s, last_order_status)
+        WHERE user_id = %s
+    """,
+        (spent, order["order_id"], new_status, order["user_id"]),
+    )
+
+
+def record_status_change(cursor, old_status, new_status):
+    if old_status == new_status:
+        return
+    if old_status is not None:
+        cursor.execute(
+            "UPDATE order_status_counts SET orders = orders - 1 WHERE status = %s",
+            (old_status,),
+        )
+    cursor.execute(
+        """
+        INSERT INTO order_status_counts (status, orders) VALUES (%s, 1)
+        ON DUPLICATE KEY UPDATE orders = orders + 1
+    """,
+        (new_status,),
+    )
+
+
+def backfill(conn):
+    """Recompute every rollup table from the hot and archived orders."""
+    cursor = conn.cursor()
+    try:
+        db.begin(conn)
+        cursor.execute("DELETE FROM daily_revenue")
+        cursor.execute(
+            """
+            INSERT INTO daily_revenue (day, orders, revenue)
+            SELECT DATE(order_date), COUNT(*),
+                   SUM(CASE WHEN status = %s THEN 0 ELSE total_price END)
+            FROM (
+                SELECT order_date, status, total_price FROM orders
+                UNION ALL
+                SELECT order_date, status, total_price FROM orders_archive
+            ) o
+            GROUP BY DATE(order_date)
+        """,
+            (CANCELLED,),
+        )
+        cursor.execute("DELETE FROM product_daily_sales")
+        cursor.execute(
+            """
+            INSERT INTO product_daily_sales (day, product_id, units, revenue)
+            SELECT DATE(oi.order_date), oi.product_id, SUM(oi.quantity),
+                   SUM(oi.quantity * oi.price_per_unit)
+            FROM (
+                SELECT o.order_date, oi.product_id, oi.quantity, oi.price_per_unit
+                FROM order_items oi JOIN orders o ON o.order_id = oi.order_id
+                WHERE NOT (o.status <=> %s)
+                UNION ALL
+                SELECT oi.order_date, oi.product_id, oi.quantity, oi.price_per_unit
+                FROM order_items_archive oi
+                JOIN orders_archive o
+                    ON o.order_id = oi.order_id AND o.order_date = oi.order_date
+                WHERE NOT (o.status <=> %s)
+            ) oi
+            GROUP BY DATE(oi.order_date), oi.product_id
+        """,
+            (CANCELLED, CANCELLED),
+        )
+        cursor.execute("DELETE FROM order_status_counts")
+        cursor.execute(
+            """
+            INSERT INTO order_status_counts (status, orders)
+            SELECT status, COUNT(*) FROM (
+                SELECT status FROM orders
+                UNION ALL
+                SELECT status FROM orders_archive
+            ) o
+            GROUP BY status
+        """
+        )
+        backfill_user_stats(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+ALL_ORDERS = """(
+    SELECT order_id, user_id, order_date, status, total_price FROM orders
+    UNION ALL
+    SELECT order_id, user_id, order_date, status, total_price FROM orders_archive
+)"""
+
+
+def backfill_user_stats(cursor):
+    """Recompute user_order_stats; the caller commits."""
+    cursor.execute("DELETE FROM user_order_stats")
+    cursor.execute(
+        f"""
+        INSERT INTO user_order_stats
+            (user_id, orders, total_spent, first_order_date, last_order_date)
+        SELECT user_id, COUNT(*),
+               SUM(CASE WHEN status = %s THEN 0 ELSE total_price END),
+               MIN(order_date), MAX(order_date)
+        FROM {ALL_ORDERS} o
+        GROUP BY user_id
+    """,
+        (CANCELLED,),
+    )
+    # last order: the highest order_id on the latest order_date
+    cursor.execute(
+        f"""
+        UPDATE user_order_stats s
+        JOIN (
+            SELECT user_id, order_date, MAX(order_id) AS order_id
+            FROM {ALL_ORDERS} o
+            GROUP BY user_id, order_date
+        ) l ON l.user_id = s.user_id AND l.order_date = s.last_order_date
+        SET s.last_order_id = l.order_id
+    """
+    )
+    cursor.execute(
+        f"""
+        UPDATE user_order_stats s
+        JOIN {ALL_ORDERS} o ON o.order_id = s.last_order_id
+        SET s.last_order_status = o.status
+    """
+    )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["backfill"]:
+        sys.exit("usage: python rollups.py backfill")
+    backfill(db.primary)
+    print("rollups rebuilt")
@@ -0,0 +1,182 @@
+"""Bulk catalog import and export as NDJSON or CSV.
+
+Imports read the upload line by line and insert it IMPORT_BATCH_SIZE rows
+at a time, one multi-row INSERT and one commit per batch. A batch the
+database rejects is retried row by row so that only the bad rows are
+reported. Exports stream the catalog from an unbuffered cursor, a chunk at
+a time, without ever holding the whole result in memory.
+"""
+
+import csv
+import io
+import json
+import os
+from decimal import Decimal
+
+from pydantic import ValidationError
+
+import db
+
+COLUMNS = [
+    "category_id",
+    "name",
+    "description",
+    "price",
+    "stock_quantity",
+    "product_image",
+]
+EXPORT_COLUMNS = ["product_id"] + COLUMNS
+BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "1000"))
+MAX_REPORTED_ERRORS = 1000
+
+INSERT_PRODUCT = (
+    "INSERT INTO products (category_id, name, description, price, stock_quantity, product_image)"
+    " VALUES (%s, %s, %s, %s, %s, %s)"
+)
+
+
+def _lines(binary_file):
+    """Yield (line number, text or UnicodeDecodeError) for each line."""
+    # decoded line by line: UploadFile.file is a SpooledTemporaryFile, which
+    # TextIOWrapper cannot wrap before Python 3.11 (no readable()). utf-8-sig
+    # drops the BOM Excel puts in front of the header.
+    for line_number, raw in enumerate(binary_file, start=1):
+        try:
+            yield line_number, raw.decode("utf-8-sig")
+        except UnicodeDecodeError as e:
+            yield line_number, e
+
+
+def _records(binary_file, fmt):
+    """Yield (line number, dict or parse error) from the uploaded file."""
+    lines = _lines(binary_file)
+    if fmt == "csv":
+        position = [0]
+        undecodable = []
+
+        def text():
+            for line_number, line in lines:
+                position[0] = line_number
+                if isinstance(line, UnicodeDecodeError):
+                    undecodable.append((line_number, line))
+                else:
+                    yield line
+
+        for record in csv.DictReader(text()):
+            yield from undecodable
+            undecodable.clear()
+            yield position[0], record
+        yield from undecodable
+        return
+    for line_number, line in lines:
+        if isinstance(line, UnicodeDecodeError):
+            yield line_number, line
+            continue
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as e:
+            yield line_number, e
+
+
+class ImportResult:
+    def __init__(self):
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line_number, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line_number, "error": message})
+
+
+def _insert_batch(conn, batch, result):
+    cursor = conn.cursor()
+    try:
+        db.begin(conn)
+        cursor.executemany(INSERT_PRODUCT, [values for _, values in batch])
+        first_id = cursor.lastrowid
+        # zero sales rows so the new products show up in sort=popular
+        cursor.execute(
+            "INSERT IGNORE INTO product_sales (product_id, category_id, units_sold)"
+            " SELECT product_id, category_id, 0 FROM products WHERE product_id >= %s",
+            (first_id,),
+        )
+        conn.commit()
+        result.inserted += len(batch)
+        return
+    except Exception:
+        conn.rollback()
+    # find the offending rows one at a time
+    for line_number, values in batch:
+        try:
+            db.begin(conn)
+            cursor.execute(INSERT_PRODUCT, values)
+            cursor.execute(
+                "INSERT INTO product_sales (product_id, category_id, units_sold) VALUES (%s, %s, 0)",
+                (cursor.lastrowid, values[0]),
+            )
+            conn.commit()
+            result.inserted += 1
+        except Exception as e:
+            conn.rollback()
+            result.error(line_number, str(e))
+
+
+def import_products(conn, binary_file, fmt, model):
+    """Validate every record with `model` and insert the valid ones."""
+    result = ImportResult()
+    batch = []
+    for line_number, record in _records(binary_file, fmt):
+        if isinstance(record, UnicodeDecodeError):
+            result.error(line_number, f"Invalid UTF-8: {record}")
+            continue
+        if isinstance(record, Exception):
+            result.error(line_number, f"Invalid JSON: {record}")
+            continue
+        try:
+            product = model(**record)
+        except (ValidationError, TypeError) as e:
+            result.error(line_number, str(e))
+            continue
+        batch.append((line_number, tuple(getattr(product, column) for column in COLUMNS)))
+        if len(batch) >= BATCH_SIZE:
+            _insert_batch(conn, batch, result)
+            batch = []
+    if batch:
+        _insert_batch(conn, batch, result)
+    return result
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def export_products(conn, fmt):
+    """Yield the whole catalog as CSV or NDJSON text chunks."""
+    cursor = conn.cursor(buffered=False)
+    cursor.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM products ORDER BY product_id")
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            if not rows:
+                return
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            return
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=_json_default) + "\n"
+            for row in rows
+        )
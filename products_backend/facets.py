@@ -0,0 +1,145 @@
+"""Facet counts for the catalog sidebar (category, price bucket, in stock).
+
+Every product falls in exactly one (category_id, price bucket, in_stock)
+cell; the counts of those cells are kept in memory, so facet counts and the
+total of a facet-filtered listing never need a COUNT query. The table is
+loaded at startup, patched per product whenever this process adds a product
+or changes stock (``reload``), and fully reloaded every
+FACET_RELOAD_SECONDS to pick up writes made by other processes.
+"""
+
+import bisect
+import os
+import threading
+import time
+from collections import Counter
+
+import db
+
+# lower edges of the price buckets; the last bucket is open-ended
+PRICE_BUCKETS = [
+    int(edge) for edge in os.environ.get("FACET_PRICE_BUCKETS", "0,500,1000,2000,5000").split(",")
+]
+RELOAD_INTERVAL = int(os.environ.get("FACET_RELOAD_SECONDS", "300"))
+
+
+def price_bucket(price):
+    """None for a NULL price or one below the first bucket; no filter matches those."""
+    if price is None or price < PRICE_BUCKETS[0]:
+        return None
+    return bisect.bisect_right(PRICE_BUCKETS, price) - 1
+
+
+def price_range(bucket):
+    """(min_price, max_price) of a bucket; max_price is None for the last."""
+    upper = PRICE_BUCKETS[bucket + 1] if bucket + 1 < len(PRICE_BUCKETS) else None
+    return PRICE_BUCKETS[bucket], upper
+
+
+def _cell(category_id, price, stock_quantity):
+    return (category_id, price_bucket(price), (stock_quantity or 0) > 0)
+
+
+class FacetCounts:
+    def __init__(self):
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._cells = {}  # product_id -> cell
+        self._counts = Counter()  # cell -> number of products
+
+    def load(self, conn):
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT product_id, category_id, price, stock_quantity FROM products"
+        )
+        cells = {row[0]: _cell(*row[1:]) for row in cursor.fetchall()}
+        conn.commit()
+        with self._lock:
+            self._cells = cells
+            self._counts = Counter(cells.values())
+            self.loaded = True
+
+    def reload(self, conn, product_ids):
+        """Re-read the given products after they were added or changed."""
+        product_ids = list(set(product_ids))
+        if not product_ids:
+            return
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT product_id, category_id, price, stock_quantity FROM products"
+            f" WHERE product_id IN ({', '.join(['%s'] * len(product_ids))})",
+            tuple(product_ids),
+        )
+        cells = {row[0]: _cell(*row[1:]) for row in cursor.fetchall()}
+        conn.commit()
+        with self._lock:
+            for product_id in product_ids:
+                old = self._cells.pop(product_id, None)
+                if old is not None:
+                    self._counts[old] -= 1
+                new = cells.get(product_id)
+                if new is not None:
+                    self._cells[product_id] = new
+                    self._counts[new] += 1
+
+    def _matching(self, category_id, bucket, in_stock):
+        with self._lock:
+            counts = list(self._counts.items())
+        return [
+            (cell, count)
+            for cell, count in counts
+            if count
+            and (category_id is None or cell[0] == category_id)
+            and (bucket is None or cell[1] == bucket)
+            and (in_stock is None or cell[2] == in_stock)
+        ]
+
+    def count(self, category_id=None, bucket=None, in_stock=None):
+        return sum(count for _, count in self._matching(category_id, bucket, in_stock))
+
+    def summary(self, category_id=None, bucket=None, in_stock=None):
+        """Counts per facet value, each facet filtered by the other two."""
+        categories = Counter()
+        for cell, count in self._matching(None, bucket, in_stock):
+            categories[cell[0]] += count
+        buckets = Counter()
+        for cell, count in self._matching(category_id, None, in_stock):
+            buckets[cell[1]] += count
+        stock = Counter()
+        for cell, count in self._matching(category_id, bucket, None):
+            stock[cell[2]] += count
+        return {
+            "categories": [
+                {"category_id": key, "count": categories[key]}
+                for key in sorted(categories, key=lambda key: (key is None, key))
+            ],
+            "price_buckets": [
+                {
+                    "price_bucket": index,
+                    "min_price": price_range(index)[0],
+                    "max_price": price_range(index)[1],
+                    "count": buckets[index],
+                }
+                for index in range(len(PRICE_BUCKETS))
+            ],
+            "in_stock": {"true": stock[True], "false": stock[False]},
+        }
+
+
+counts = FacetCounts()
+
+
+def _run_reload():
+    conn = db.connect()
+    while True:
+        try:
+            if not conn.is_connected():
+                conn.reconnect()
+            counts.load(conn)
+        except Exception as e:
+            print(f"facet counts reload failed: {e}")
+        time.sleep(RELOAD_INTERVAL)
+
+
+def start_background_reload():
+    threading.Thread(target=_run_reload, daemon=True).start()
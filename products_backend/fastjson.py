@@ -0,0 +1,73 @@
+"""Fast JSON responses for data the handler built itself.
+
+Every service that uses it keeps an identical copy of this module.
+
+Returning a Response skips FastAPI's second pass over the result: no
+response_model validation and no jsonable_encoder. The body is encoded once
+with orjson. Only use this for data shaped by our own code from our own
+tables. The endpoint keeps its response_model so the OpenAPI docs stay the
+same.
+
+``ResponseCache`` keeps ready-to-send bodies for hot endpoints. Entries
+belong to a version (e.g. the catalog snapshot they were built from) and
+are all dropped the first time a newer version is asked for.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+
+import orjson  # type: ignore
+from fastapi import Response
+
+CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "512"))
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(content):
+    return orjson.dumps(content, default=_default)
+
+
+def response(content=None, body=None, status_code=200):
+    """A JSON response from content, or from an already encoded body."""
+    return Response(
+        content=body if body is not None else dumps(content),
+        status_code=status_code,
+        media_type="application/json",
+    )
+
+
+class ResponseCache:
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.version = None
+        self._lock = threading.Lock()
+        self._bodies = OrderedDict()
+
+    def get(self, version, key):
+        """Versions only go up; a request still on an older one just misses."""
+        with self._lock:
+            if self.version is None or version > self.version:
+                self.version = version
+                self._bodies.clear()
+                return None
+            if version < self.version:
+                return None
+            body = self._bodies.get(key)
+            if body is not None:
+                self._bodies.move_to_end(key)
+            return body
+
+    def put(self, version, key, body):
+        with self._lock:
+            if version != self.version:
+                return
+            self._bodies[key] = body
+            if len(self._bodies) > self.size:
+                self._bodies.popitem(last=False)
@@ -0,0 +1,103 @@
+"""Content-addressed product images.
+
+Uploads are stored once under images/blobs/<first two hex chars>/<sha256>.<ext>
+and never overwritten, so they are served with a one-year immutable
+Cache-Control and a changed photo simply gets a new URL. Blobs that no
+product points to any more are removed by ``collect_garbage`` (a
+background thread, every IMAGE_GC_INTERVAL_SECONDS), once they are older
+than IMAGE_GC_GRACE_SECONDS so uploads still in flight are left alone.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from fastapi.staticfiles import StaticFiles
+
+import db
+
+# next to this file, so the combined deployment (run from the repo root)
+# serves the same files
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+BLOBS_DIR = os.path.join(IMAGES_DIR, "blobs")
+URL_PREFIX = "api/products/images/"
+EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif"}
+IMMUTABLE = "public, max-age=31536000, immutable"
+GC_GRACE = int(os.environ.get("IMAGE_GC_GRACE_SECONDS", "3600"))
+GC_INTERVAL = int(os.environ.get("IMAGE_GC_INTERVAL_SECONDS", "86400"))
+
+
+class ImageFiles(StaticFiles):
+    """StaticFiles (with its Range support) plus immutable caching of blobs."""
+
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        if path.replace(os.sep, "/").startswith("blobs/") and response.status_code < 400:
+            response.headers["Cache-Control"] = IMMUTABLE
+        return response
+
+
+def store(upload, filename=None):
+    """Store an uploaded file object; returns its URL path for product_image."""
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext not in EXTENSIONS:
+        ext = ".jpg"
+    os.makedirs(BLOBS_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=BLOBS_DIR, delete=False) as tmp:
+        for chunk in iter(lambda: upload.read(1024 * 1024), b""):
+            digest.update(chunk)
+            tmp.write(chunk)
+    name = digest.hexdigest() + ext
+    relative = os.path.join("blobs", name[:2], name)
+    target = os.path.join(IMAGES_DIR, relative)
+    if os.path.exists(target):
+        # identical bytes were uploaded before; refresh the mtime so the
+        # garbage collector's grace period covers this new reference too
+        os.remove(tmp.name)
+        os.utime(target)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.chmod(tmp.name, 0o644)
+        shutil.move(tmp.name, target)
+    return URL_PREFIX + relative.replace(os.sep, "/")
+
+
+def collect_garbage(conn):
+    """Delete blobs no product references. Returns how many were removed."""
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT product_image FROM products WHERE product_image LIKE %s",
+        (URL_PREFIX + "blobs/%",),
+    )
+    referenced = {row[0][len(URL_PREFIX) :] for row in cursor.fetchall()}
+    conn.commit()
+    removed = 0
+    cutoff = time.time() - GC_GRACE
+    for root, _, files in os.walk(BLOBS_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, IMAGES_DIR).replace(os.sep, "/")
+            if relative not in referenced and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+def _run_gc():
+    conn = db.connect()
+    while True:
+        try:
+            if not conn.is_connected():
+                conn.reconnect()
+            collect_garbage(conn)
+        except Exception as e:
+            print(f"image garbage collection failed: {e}")
+        time.sleep(GC_INTERVAL)
+
+
+def start_background_gc():
+    threading.Thread(target=_run_gc, daemon=True).start()
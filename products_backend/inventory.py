@@ -0,0 +1,435 @@
+"""Stock reservations for checkout.
+
+Reserving takes stock out of ``products.stock_quantity`` with a conditional
+UPDATE and records it in ``stock_reservations`` with an expiry time. The order
+service confirms reservations when the order is placed; reservations that
+are still held when they expire are given back by the sweeper.
+
+Hot products can have their stock split over several rows of
+``stock_shards``. Each reservation then decrements one randomly chosen shard,
+so concurrent checkouts of the same product lock different rows. For a
+sharded product the shards are the source of truth and the reconciler
+periodically folds their sum back into ``products.stock_quantity`` (and
+evens out the shards so that no shard runs dry while others still have
+stock).
+
+Reservations, releases and reconciling only move stock around, so they
+leave the catalog snapshot (snapshot.py) to its periodic rebuild: a
+rebuild per checkout would re-read the whole catalog and empty the
+response cache every couple of seconds during a sale. Stock shown in
+listings can therefore lag by up to CATALOG_SNAPSHOT_SECONDS. set_shards
+and bulk_update (which also sets prices) still ask for a rebuild.
+"""
+
+import os
+import random
+import threading
+import time
+
+import db
+import facets
+import snapshot
+
+RESERVATION_TTL = int(os.environ.get("RESERVATION_TTL_SECONDS", "600"))
+SWEEP_INTERVAL = int(os.environ.get("RESERVATION_SWEEP_INTERVAL_SECONDS", "30"))
+RECONCILE_INTERVAL = int(os.environ.get("STOCK_RECONCILE_INTERVAL_SECONDS", "60"))
+SWEEP_BATCH_SIZE = 100
+
+
+class OutOfStock(Exception):
+    def __init__(self, product_id):
+        super().__init__(f"Not enough stock for product {product_id}")
+        self.product_id = product_id
+
+
+def _shard_numbers(cursor, product_id, locking=False):
+    cursor.execute(
+        "SELECT shard_no FROM stock_shards WHERE product_id = %s"
+        + (" LOCK IN SHARE MODE" if locking else ""),
+        (product_id,),
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _take_from_shards(cursor, product_id, shards, quantity):
+    """Return a list of (shard_no, quantity) pieces that add up to quantity."""
+    random.shuffle(shards)
+    # fast path: one shard has enough, only that row gets locked
+    for shard_no in shards:
+        cursor.execute(
+            "UPDATE stock_shards SET quantity = quantity - %s"
+            " WHERE product_id = %s AND shard_no = %s AND quantity >= %s",
+            (quantity, product_id, shard_no, quantity),
+        )
+        if cursor.rowcount == 1:
+            return [(shard_no, quantity)]
+
+    # slow path: stock is spread too thin, lock every shard and collect it
+    cursor.execute(
+        "SELECT shard_no, quantity FROM stock_shards"
+        " WHERE product_id = %s AND quantity > 0 FOR UPDATE",
+        (product_id,),
+    )
+    rows = cursor.fetchall()
+    if sum(row[1] for row in rows) < quantity:
+        raise OutOfStock(product_id)
+    pieces = []
+    remaining = quantity
+    for shard_no, available in rows:
+        taken = min(available, remaining)
+        cursor.execute(
+            "UPDATE stock_shards SET quantity = quantity - %s"
+            " WHERE product_id = %s AND shard_no = %s",
+            (taken, product_id, shard_no),
+        )
+        pieces.append((shard_no, taken))
+        remaining -= taken
+        if remaining == 0:
+            break
+    return pieces
+
+
+def reserve(conn, user_id, items):
+    """Reserve every (product_id, quantity) in items, all or nothing."""
+    cursor = conn.cursor()
+    reservations = []
+    try:
+        db.begin(conn)
+        # on the database clock, which add_order and the sweeper compare
+        # expires_at against
+        cursor.execute("SELECT NOW() + INTERVAL %s SECOND", (RESERVATION_TTL,))
+        expires_at = cursor.fetchone()[0]
+        for product_id, quantity in items:
+            shards = _shard_numbers(cursor, product_id)
+            if not shards:
+                cursor.execute(
+                    "UPDATE products SET stock_quantity = stock_quantity - %s"
+                    " WHERE product_id = %s AND stock_quantity >= %s",
+                    (quantity, product_id, quantity),
+                )
+                if cursor.rowcount != 1:
+                    raise OutOfStock(product_id)
+                # set_shards holds this product row for its whole transaction,
+                # so now that we hold it too a locking read sees any shards it
+                # committed since the plain lookup above. Locking the shards
+                # up front instead would deadlock concurrent reservations,
+                # which each go on to update one of the share-locked rows.
+                shards = _shard_numbers(cursor, product_id, locking=True)
+                if shards:
+                    cursor.execute(
+                        "UPDATE products SET stock_quantity = stock_quantity + %s"
+                        " WHERE product_id = %s",
+                        (quantity, product_id),
+                    )
+            if shards:
+                pieces = _take_from_shards(cursor, product_id, shards, quantity)
+            else:
+                pieces = [(None, quantity)]
+            for shard_no, taken in pieces:
+                cursor.execute(
+                    "INSERT INTO stock_reservations (user_id, product_id, shard_no, quantity, status, expires_at)"
+                    " VALUES (%s, %s, %s, %s, 'held', %s)",
+                    (user_id, product_id, shard_no, taken, expires_at),
+                )
+                reservations.append(
+                    {
+                        "reservation_id": cursor.lastrowid,
+                        "product_id": product_id,
+                        "quantity": taken,
+                        "expires_at": expires_at.strftime("%Y-%m-%d %H:%M:%S"),
+                    }
+                )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    facets.counts.reload(conn, [product_id for product_id, _ in items])
+    return reservations
+
+
+def _give_back(cursor, rows):
+    for product_id, shard_no, quantity in rows:
+        if shard_no is None:
+            cursor.execute(
+                "UPDATE products SET stock_quantity = stock_quantity + %s WHERE product_id = %s",
+                (quantity, product_id),
+            )
+        else:
+            cursor.execute(
+                "UPDATE stock_shards SET quantity = quantity + %s"
+                " WHERE product_id = %s AND shard_no = %s",
+                (quantity, product_id, shard_no),
+            )
+
+
+def release(conn, reservation_ids, user_id=None):
+    """Give back held reservations (e.g. checkout abandoned). Returns count.
+
+    With user_id, only that user's reservations are released.
+    """
+    if not reservation_ids:
+        return 0
+    cursor = conn.cursor()
+    placeholders = ", ".join(["%s"] * len(reservation_ids))
+    params = tuple(reservation_ids)
+    owner = ""
+    if user_id is not None:
+        owner = " AND user_id = %s"
+        params += (user_id,)
+    try:
+        db.begin(conn)
+        cursor.execute(
+            f"SELECT reservation_id, product_id, shard_no, quantity FROM stock_reservations"
+            f" WHERE reservation_id IN ({placeholders}){owner} AND status = 'held' FOR UPDATE",
+            params,
+        )
+        rows = cursor.fetchall()
+        _give_back(cursor, [row[1:] for row in rows])
+        if rows:
+            cursor.execute(
+                f"UPDATE stock_reservations SET status = 'released'"
+                f" WHERE reservation_id IN ({', '.join(['%s'] * len(rows))})",
+                tuple(row[0] for row in rows),
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    facets.counts.reload(conn, [row[1] for row in rows])
+    return len(rows)
+
+
+def release_expired(conn):
+    """Release one batch of expired reservations. Returns how many."""
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT reservation_id FROM stock_reservations"
+        " WHERE status = 'held' AND expires_at < NOW() LIMIT %s",
+        (SWEEP_BATCH_SIZE,),
+    )
+    expired = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    return release(conn, expired)
+
+
+def set_shards(conn, product_id, shards):
+    """Spread a product's stock over `shards` rows; 0 folds it back."""
+    cursor = conn.cursor()
+    try:
+        db.begin(conn)
+        cursor.execute(
+            "SELECT stock_quantity FROM products WHERE product_id = %s FOR UPDATE",
+            (product_id,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            raise LookupError(product_id)
+        cursor.execute(
+            "SELECT COALESCE(SUM(quantity), 0), COUNT(*) FROM stock_shards"
+            " WHERE product_id = %s FOR UPDATE",
+            (product_id,),
+        )
+        sharded_total, shard_count = cursor.fetchone()
+        total = int(sharded_total) if shard_count else row[0]
+        cursor.execute("DELETE FROM stock_shards WHERE product_id = %s", (product_id,))
+        if shards > 0:
+            cursor.executemany(
+                "INSERT INTO stock_shards (product_id, shard_no, quantity) VALUES (%s, %s, %s)",
+                [
+                    (product_id, shard_no, quantity)
+                    for shard_no, quantity in enumerate(_split(total, shards))
+                ],
+            )
+        cursor.execute(
+            "UPDATE products SET stock_quantity = %s WHERE product_id = %s",
+            (total, product_id),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    facets.counts.reload(conn, [product_id])
+    snapshot.mark_dirty()
+    return total
+
+
+def _split(total, parts):
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def reconcile(conn):
+    """Fold shard totals into products.stock_quantity and even out shards."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT product_id FROM stock_shards")
+    product_ids = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    for product_id in product_ids:
+        # one short transaction per product keeps the shard locks brief
+        try:
+            db.begin(conn)
+            cursor.execute(
+                "SELECT shard_no, quantity FROM stock_shards WHERE product_id = %s FOR UPDATE",
+                (product_id,),
+            )
+            rows = cursor.fetchall()
+            total = sum(row[1] for row in rows)
+            for (shard_no, quantity), target in zip(rows, _split(total, len(rows))):
+                if quantity != target:
+                    cursor.execute(
+                        "UPDATE stock_shards SET quantity = %s WHERE product_id = %s AND shard_no = %s",
+                        (target, product_id, shard_no),
+                    )
+            cursor.execute(
+                "UPDATE products SET stock_quantity = %s WHERE product_id = %s",
+                (total, product_id),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    facets.counts.reload(conn, product_ids)
+    return len(product_ids)
+
+
+def _held(cursor, product_id):
+    cursor.execute(
+        "SELECT COALESCE(SUM(quantity), 0) FROM stock_reservations"
+        " WHERE product_id = %s AND status = 'held'",
+        (product_id,),
+    )
+    return int(cursor.fetchone()[0])
+
+
+def bulk_update(conn, updates):
+    """Apply many (product_id, stock_quantity, stock_delta, price) at once.
+
+    stock_quantity is an absolute warehouse count: stock currently held by
+    reservations is subtracted from it, so products.stock_quantity stays the
+    available count. stock_delta is added to the available count. Any of
+    the three values may be None to leave it unchanged. Stock never drops
+    below zero.
+    """
+    cursor = conn.cursor()
+    try:
+        db.begin(conn)
+        cursor.execute(
+            """
+            CREATE TEMPORARY TABLE IF NOT EXISTS bulk_stock_updates (
+                product_id int PRIMARY KEY,
+                stock_quantity int,
+                stock_delta int,
+                price decimal
+            )
+            """
+        )
+        cursor.execute("DELETE FROM bulk_stock_updates")
+        cursor.executemany(
+            "INSERT INTO bulk_stock_updates (product_id, stock_quantity, stock_delta, price)"
+            " VALUES (%s, %s, %s, %s)"
+            " ON DUPLICATE KEY UPDATE stock_quantity = VALUES(stock_quantity),"
+            " stock_delta = VALUES(stock_delta), price = VALUES(price)",
+            updates,
+        )
+        cursor.execute(
+            """
+            SELECT u.product_id FROM bulk_stock_updates u
+            LEFT JOIN products p ON p.product_id = u.product_id
+            WHERE p.product_id IS NULL
+            """
+        )
+        not_found = [row[0] for row in cursor.fetchall()]
+
+        cursor.execute(
+            """
+            UPDATE products p JOIN bulk_stock_updates u ON u.product_id = p.product_id
+            SET p.price = u.price
+            WHERE u.price IS NOT NULL
+            """
+        )
+        cursor.execute(
+            """
+            UPDATE products p
+            JOIN bulk_stock_updates u ON u.product_id = p.product_id
+            LEFT JOIN (
+                SELECT product_id, SUM(quantity) AS held FROM stock_reservations
+                WHERE status = 'held' GROUP BY product_id
+            ) r ON r.product_id = p.product_id
+            SET p.stock_quantity = CASE
+                WHEN u.stock_quantity IS NOT NULL
+                    THEN GREATEST(u.stock_quantity - COALESCE(r.held, 0), 0)
+                ELSE GREATEST(p.stock_quantity + u.stock_delta, 0)
+            END
+            WHERE (u.stock_quantity IS NOT NULL OR u.stock_delta IS NOT NULL)
+              AND NOT EXISTS (SELECT 1 FROM stock_shards s WHERE s.product_id = p.product_id)
+            """
+        )
+
+        # sharded (hot) products are few; rewrite their shards one by one
+        cursor.execute(
+            """
+            SELECT DISTINCT s.product_id FROM stock_shards s
+            JOIN bulk_stock_updates u ON u.product_id = s.product_id
+            WHERE u.stock_quantity IS NOT NULL OR u.stock_delta IS NOT NULL
+            """
+        )
+        sharded = [row[0] for row in cursor.fetchall()]
+        for product_id in sharded:
+            cursor.execute(
+                "SELECT stock_quantity, stock_delta FROM bulk_stock_updates WHERE product_id = %s",
+                (product_id,),
+            )
+            absolute, delta = cursor.fetchone()
+            cursor.execute(
+                "SELECT shard_no, quantity FROM stock_shards WHERE product_id = %s FOR UPDATE",
+                (product_id,),
+            )
+            rows = cursor.fetchall()
+            if absolute is not None:
+                total = max(absolute - _held(cursor, product_id), 0)
+            else:
+                total = max(sum(row[1] for row in rows) + delta, 0)
+            for (shard_no, _), quantity in zip(rows, _split(total, len(rows))):
+                cursor.execute(
+                    "UPDATE stock_shards SET quantity = %s WHERE product_id = %s AND shard_no = %s",
+                    (quantity, product_id, shard_no),
+                )
+            cursor.execute(
+                "UPDATE products SET stock_quantity = %s WHERE product_id = %s",
+                (total, product_id),
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    missing = set(not_found)
+    updated = [update[0] for update in updates if update[0] not in missing]
+    facets.counts.reload(conn, updated)
+    snapshot.mark_dirty()
+    return {
+        "received": len(updates),
+        "updated": len(set(updated)),
+        "sharded": len(sharded),
+        "not_found": not_found,
+    }
+
+
+def _run_background_jobs():
+    # own connection: the request handlers share db.primary
+    conn = db.connect()
+    last_reconcile = 0.0
+    while True:
+        try:
+            if not conn.is_connected():
+                conn.reconnect()
+            while release_expired(conn) == SWEEP_BATCH_SIZE:
+                pass
+            if time.monotonic() - last_reconcile >= RECONCILE_INTERVAL:
+                reconcile(conn)
+                last_reconcile = time.monotonic()
+        except Exception as e:
+            print(f"inventory background job failed: {e}")
+        time.sleep(SWEEP_INTERVAL)
+
+
+def start_background_jobs():
+    threading.Thread(target=_run_background_jobs, daemon=True).start()
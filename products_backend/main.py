@@ -1,5 +1,4 @@
 from fastapi import HTTPException
-import shutil
 from typing import Annotated, List, Optional
 from fastapi import Depends, FastAPI, File, Form, Query, Security, UploadFile
 from fastapi.security import (
@@ -7,19 +6,26 @@ from fastapi.security import (
     HTTPBearer,
     OAuth2PasswordBearer,
 )
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from fastapi import status
 
 
 # import libraries เกี่ยวกับ mysql
 from jose import JWTError, jwt  # type: ignore
-import mysql.connector  # type: ignore
+import db
+import tracing
+import inventory
+import related
+import sales
+import facets
+import catalog_io
+import images
+import snapshot
+import fastjson
 
 
-mydb = mysql.connector.connect(
-    host="mysql", user="user", password="password", database="flowerstore"
-)
+mydb = db.primary
 
 
 app = FastAPI(docs_url="/api/products/docs", openapi_url="/api/products/openapi.json")
@@ -35,6 +41,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(tracing.TraceMiddleware, service="products")
 
 from jose import jwt, JWTError  # type: ignore
 
@@ -47,13 +54,13 @@ security = HTTPBearer()
 # เช็คว่ามี โฟลเดอร์ images หรือไม่ ถ้าไม่มีให้สร้างโฟลเดอร์ images
 import os
 
-if not os.path.exists("images"):
-    os.makedirs("images")
+if not os.path.exists(images.IMAGES_DIR):
+    os.makedirs(images.IMAGES_DIR)
 
 
 app.mount(
     "/api/products/images",
-    app=StaticFiles(directory="images"),
+    app=images.ImageFiles(directory=images.IMAGES_DIR),
     name="images",
 )
 
@@ -101,74 +108,219 @@ class Product(BaseModel):
     product_image: str
 
 
-@app.get("/api/products/get_products")
-def get_products(
-    category_id: Optional[int] = None,
-    page: int = 1,
-    limit: int = 10,
-):
-    mycursor = mydb.cursor()
+# columns a listing can be narrowed to with ?fields=, and the SQL for each
+PRODUCT_FIELDS = {
+    "product_id": "p.product_id",
+    "category_id": "p.category_id",
+    "category_name": "c.name",
+    "name": "p.name",
+    "description": "p.description",
+    "price": "p.price",
+    "stock_quantity": "p.stock_quantity",
+    "product_image": "p.product_image",
+}
+
+FIELD_PRESETS = {
+    "card": ["product_id", "name", "price", "product_image"],
+    "detail": list(PRODUCT_FIELDS),
+}
+
+
+def parse_fields(fields: Optional[str], available):
+    """Turn "card" or "name,price" into a list of field names, in order."""
+    if fields is None:
+        return list(available)
+    selected = []
+    for field in fields.split(","):
+        field = field.strip()
+        for name in FIELD_PRESETS.get(field, [field]):
+            if name not in available:
+                raise HTTPException(status_code=400, detail=f"Unknown field: {name}")
+            if name not in selected:
+                selected.append(name)
+    return selected
+
+
+# ORDER BY for each ?sort=; every one of them is backed by an index (see
+# init.sql), popular through the product_sales table kept by sales.py
+SORT_ORDERS = {
+    "price_asc": "p.price ASC, p.product_id ASC",
+    "price_desc": "p.price DESC, p.product_id DESC",
+    "newest": "p.product_id DESC",
+    "popular": "s.units_sold DESC, s.product_id DESC",
+}
+
+
+@app.on_event("startup")
+def start_sales_refresh():
+    sales.start_background_refresh()
+
+
+@app.on_event("startup")
+def start_facet_reload():
+    facets.start_background_reload()
+
+
+@app.on_event("startup")
+def start_snapshot_builder():
+    snapshot.start_background_builder()
+
+
+# first pages of listings and the category list, as ready-to-send bytes for
+# the current catalog snapshot
+CACHED_PAGES = int(os.environ.get("PRODUCTS_CACHED_PAGES", "3"))
+# larger pages are not cached, which bounds the size of every cached body
+CACHED_MAX_LIMIT = int(os.environ.get("PRODUCTS_CACHED_MAX_LIMIT", "100"))
+responses = fastjson.ResponseCache()
+
+
+def query_products(selected, category_id, price_bucket, in_stock, sort, page, limit):
+    """A listing page and its total straight from MySQL (no snapshot yet)."""
+    mycursor = db.reader().cursor()
+
+    if sort == "popular":
+        # drive the scan from product_sales so (category_id, units_sold) is used
+        from_clause = "product_sales s JOIN products p ON p.product_id = s.product_id"
+        category_column = "s.category_id"
+    else:
+        from_clause = "products p"
+        category_column = "p.category_id"
 
     # Modified query to include category name
-    query = """
-    SELECT p.*, c.name AS category_name 
-    FROM products p 
-    LEFT JOIN categories c ON p.category_id = c.category_id
+    query = f"""
+    SELECT {", ".join(PRODUCT_FIELDS[name] for name in selected)}
+    FROM {from_clause}
     """
-    
+    if "category_name" in selected:
+        query += " LEFT JOIN categories c ON p.category_id = c.category_id"
+
+    conditions = []
+    params = []
+    if price_bucket is not None:
+        min_price, max_price = facets.price_range(price_bucket)
+        conditions.append("p.price >= %s")
+        params.append(min_price)
+        if max_price is not None:
+            conditions.append("p.price < %s")
+            params.append(max_price)
+    if in_stock is not None:
+        conditions.append("p.stock_quantity > 0" if in_stock else "p.stock_quantity <= 0")
     if category_id is not None:
-        query += " WHERE p.category_id=%s"
-        query += " LIMIT %s OFFSET %s"
-        mycursor.execute(query, (category_id, limit, (page - 1) * limit))
-    else:
-        query += " LIMIT %s OFFSET %s"
-        mycursor.execute(query, (limit, (page - 1) * limit))
+        params.insert(0, category_id)
+
+    def where(category_column):
+        clauses = ([f"{category_column}=%s"] if category_id is not None else [])
+        clauses += conditions
+        return " WHERE " + " AND ".join(clauses) if clauses else ""
+
+    query += where(category_column)
+    if sort is not None:
+        query += f" ORDER BY {SORT_ORDERS[sort]}"
+    query += " LIMIT %s OFFSET %s"
+    mycursor.execute(query, tuple(params) + (limit, (page - 1) * limit))
     myresult = mycursor.fetchall()
 
-    products = [
-        {
-            "product_id": product[0],
-            "category_id": product[1],
-            "category_name": product[7],  # Category name is now fetched from index 7
-            "name": product[2],
-            "description": product[3],
-            "price": product[4],
-            "stock_quantity": product[5],
-            "product_image": product[6],
-        }
-        for product in myresult
-    ]
+    products = [dict(zip(selected, product)) for product in myresult]
 
-    # Get total count of items in the products table
-    if category_id is not None:
+    # Get total count of items in the products table; every filter here is a
+    # facet, so once the facet counts are loaded the total comes from memory
+    if facets.counts.loaded:
+        total_count = facets.counts.count(category_id, price_bucket, in_stock)
+    else:
         mycursor.execute(
-            "SELECT COUNT(*) FROM products WHERE category_id=%s", (category_id,)
+            "SELECT COUNT(*) FROM products p" + where("p.category_id"), tuple(params)
+        )
+        total_count = mycursor.fetchone()[0]
+    return products, total_count
+
+
+@app.get("/api/products/get_products")
+def get_products(
+    category_id: Optional[int] = None,
+    page: int = Query(1, ge=1),
+    limit: int = Query(10, ge=1),
+    fields: Optional[str] = Query(
+        None, description="Comma separated field names or a preset: card, detail"
+    ),
+    sort: Optional[str] = Query(
+        None, description="price_asc, price_desc, newest or popular"
+    ),
+    price_bucket: Optional[int] = Query(
+        None, ge=0, lt=len(facets.PRICE_BUCKETS), description="See get_facets"
+    ),
+    in_stock: Optional[bool] = None,
+    with_facets: bool = False,
+):
+    selected = parse_fields(fields, PRODUCT_FIELDS)
+    if sort is not None and sort not in SORT_ORDERS:
+        raise HTTPException(status_code=400, detail=f"Unknown sort: {sort}")
+    snap = snapshot.current()
+    cache_key = None
+    if (
+        snap is not None
+        and page <= CACHED_PAGES
+        and limit <= CACHED_MAX_LIMIT
+        and not with_facets
+    ):
+        cache_key = (
+            "products", category_id, page, limit, tuple(selected), sort, price_bucket, in_stock
+        )
+        body = responses.get(snap.version, cache_key)
+        if body is not None:
+            return fastjson.response(body=body)
+    if snap is not None:
+        products, total_count = snap.products(
+            selected, category_id, price_bucket, in_stock, sort, (page - 1) * limit, limit
         )
     else:
-        mycursor.execute("SELECT COUNT(*) FROM products")
-    total_count = mycursor.fetchone()[0]
+        products, total_count = query_products(
+            selected, category_id, price_bucket, in_stock, sort, page, limit
+        )
     total_pages = (total_count + limit - 1) // limit
 
-    return {
+    response = {
         "items": products,
         "current_page": page,
         "total_pages": total_pages,
         "total_items": total_count,
         "limit": limit,
     }
-    
+    if with_facets:
+        response["facets"] = facets.counts.summary(category_id, price_bucket, in_stock)
+    body = fastjson.dumps(response)
+    if cache_key is not None:
+        responses.put(snap.version, cache_key, body)
+    return fastjson.response(body=body)
+
+
+# facet sidebar counts, served from memory (see facets.py)
+@app.get("/api/products/get_facets")
+def get_facets(
+    category_id: Optional[int] = None,
+    price_bucket: Optional[int] = Query(None, ge=0, lt=len(facets.PRICE_BUCKETS)),
+    in_stock: Optional[bool] = None,
+):
+    return facets.counts.summary(category_id, price_bucket, in_stock)
+
+
 #get product by product_id
 @app.get("/api/products/get_product_by_id")
 def get_product_by_id(product_id: int = Query(...)):
-    mycursor = mydb.cursor()
+    snap = snapshot.current()
+    product = snap.product(product_id, PRODUCT_FIELDS) if snap is not None else None
+    if product is not None:
+        return fastjson.response(product)
+    # not in the snapshot (yet): a product added since the last rebuild
+    conn = db.reader()
+    mycursor = conn.cursor()
     query = "SELECT * FROM products WHERE product_id = %s"
     mycursor.execute(query, (product_id,))
     myresult = mycursor.fetchone()
-    categoryCursor = mydb.cursor()
-    categoryCursor.execute("SELECT name FROM categories WHERE category_id = %s", (myresult[1],))
-    category = categoryCursor.fetchone()
     if myresult is None:
         raise HTTPException(status_code=404, detail="Product not found")
+    categoryCursor = conn.cursor()
+    categoryCursor.execute("SELECT name FROM categories WHERE category_id = %s", (myresult[1],))
+    category = categoryCursor.fetchone()
     product = {
         "product_id": myresult[0],
         "category_id": myresult[1],
@@ -184,15 +336,16 @@ def get_product_by_id(product_id: int = Query(...)):
 #get product by product_name
 @app.get("/api/products/get_product_by_name")
 def get_product_by_name(product_name: str = Query(...)):
-    mycursor = mydb.cursor()
+    conn = db.reader()
+    mycursor = conn.cursor()
     query = "SELECT * FROM products WHERE name = %s"
     mycursor.execute(query, (product_name,))
     myresult = mycursor.fetchone()
-    categoryCursor = mydb.cursor()
-    categoryCursor.execute("SELECT name FROM categories WHERE category_id = %s", (myresult[1],))
-    category = categoryCursor.fetchone()
     if myresult is None:
         raise HTTPException(status_code=404, detail="Product not found")
+    categoryCursor = conn.cursor()
+    categoryCursor.execute("SELECT name FROM categories WHERE category_id = %s", (myresult[1],))
+    category = categoryCursor.fetchone()
     product = {
         "product_id": myresult[0],
         "category_id": myresult[1],
@@ -207,11 +360,115 @@ def get_product_by_name(product_name: str = Query(...)):
 
 
 
+def product_to_dict(product, category_name):
+    return {
+        "product_id": product[0],
+        "category_id": product[1],
+        "category_name": category_name,
+        "name": product[2],
+        "description": product[3],
+        "price": product[4],
+        "stock_quantity": product[5],
+        "product_image": product[6],
+    }
+
+
+# everything the product detail page needs in one request
+@app.get("/api/products/get_product_page")
+def get_product_page(product_id: int = Query(...)):
+    mycursor = db.reader().cursor()
+    mycursor.execute(
+        """
+        SELECT p.*, c.name AS category_name
+        FROM products p
+        LEFT JOIN categories c ON p.category_id = c.category_id
+        WHERE p.product_id = %s
+        """,
+        (product_id,),
+    )
+    myresult = mycursor.fetchone()
+    if myresult is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    mycursor.execute("SELECT * FROM categories")
+    categories = [
+        {"category_id": category[0], "name": category[1]}
+        for category in mycursor.fetchall()
+    ]
+    return {
+        "product": product_to_dict(myresult, myresult[7]),
+        "categories": categories,
+    }
+
+
+# the home page: every category with its first products, fetched with a
+# single UNION ALL instead of one get_products call per category
+@app.get("/api/products/get_home_page")
+def get_home_page(per_category: int = Query(8, ge=1, le=50)):
+    mycursor = db.reader().cursor()
+    mycursor.execute("SELECT * FROM categories")
+    categories = mycursor.fetchall()
+    items = {category[0]: [] for category in categories}
+    if categories:
+        query = " UNION ALL ".join(
+            ["(SELECT * FROM products WHERE category_id = %s LIMIT %s)"]
+            * len(categories)
+        )
+        params = []
+        for category in categories:
+            params += [category[0], per_category]
+        mycursor.execute(query, tuple(params))
+        names = dict(categories)
+        for product in mycursor.fetchall():
+            items[product[1]].append(product_to_dict(product, names[product[1]]))
+    return {
+        "sections": [
+            {
+                "category_id": category[0],
+                "name": category[1],
+                "items": items[category[0]],
+            }
+            for category in categories
+        ]
+    }
+
+
+@app.on_event("startup")
+def start_related_refresh():
+    related.start_background_refresh()
+
+
+# "customers also bought", served from the precomputed index in related.py
+@app.get("/api/products/related")
+def get_related_products(
+    product_id: int = Query(..., ge=1),
+    limit: int = Query(10, ge=1, le=related.TOP_K),
+    with_products: bool = False,
+):
+    items = related.index.lookup(product_id, limit)
+    if with_products and items:
+        ids = [item["product_id"] for item in items]
+        mycursor = db.reader().cursor()
+        mycursor.execute(
+            f"""
+            SELECT p.*, c.name AS category_name
+            FROM products p
+            LEFT JOIN categories c ON p.category_id = c.category_id
+            WHERE p.product_id IN ({", ".join(["%s"] * len(ids))})
+            """,
+            tuple(ids),
+        )
+        products = {row[0]: product_to_dict(row, row[7]) for row in mycursor.fetchall()}
+        for item in items:
+            item["product"] = products.get(item["product_id"])
+    return {"product_id": product_id, "items": items}
+
+
 # post new product with better error handling and status codes
 @app.post("/api/products/add_product", status_code=status.HTTP_201_CREATED)
 def add_product(product: Product, current_user: TokenData = Depends(get_current_user)):
 
     try:
+        db.begin(mydb)
         mycursor = mydb.cursor()
         sql = "INSERT INTO products (category_id, name, description, price, stock_quantity, product_image) VALUES (%s, %s, %s, %s, %s, %s)"
         values = (
@@ -223,16 +480,86 @@ def add_product(product: Product, current_user: TokenData = Depends(get_current_
             product.product_image,
         )
         mycursor.execute(sql, values)
+        product_id = mycursor.lastrowid
+        # so the new product shows up in sort=popular before the next refresh
+        mycursor.execute(
+            "INSERT INTO product_sales (product_id, category_id, units_sold) VALUES (%s, %s, 0)",
+            (product_id, product.category_id),
+        )
         mydb.commit()
+        facets.counts.reload(mydb, [product_id])
+        snapshot.mark_dirty()
         return {
             "message": "Product added successfully",
-            "product_id": mycursor.lastrowid,
+            "product_id": product_id,
         }
     except Exception as e:
         mydb.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
 
+CATALOG_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def catalog_format(fmt: Optional[str], filename: Optional[str] = None):
+    if fmt is None and filename:
+        fmt = "csv" if filename.lower().endswith(".csv") else "ndjson"
+    fmt = fmt or "ndjson"
+    if fmt not in CATALOG_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {fmt}")
+    return fmt
+
+
+# bulk load products from an NDJSON or CSV upload (one product per line /
+# row, same fields as add_product); bad rows are reported, not fatal
+@app.post("/api/products/import")
+def import_products(
+    file: UploadFile = File(...),
+    format: Optional[str] = Form(None),
+    current_user: TokenData = Depends(get_current_user),
+):
+    fmt = catalog_format(format, file.filename)
+    # a connection of its own: the import commits batch by batch
+    conn = db.connect()
+    try:
+        result = catalog_io.import_products(conn, file.file, fmt, Product)
+        facets.counts.load(conn)
+        snapshot.mark_dirty()
+    finally:
+        conn.close()
+    return {
+        "inserted": result.inserted,
+        "failed": result.failed,
+        "errors": result.errors,
+    }
+
+
+@app.get("/api/products/export")
+def export_products(
+    format: Optional[str] = Query(None, description="ndjson (default) or csv"),
+    current_user: TokenData = Depends(get_current_user),
+):
+    fmt = catalog_format(format)
+    conn = db.connect_reader()
+
+    def stream():
+        try:
+            yield from catalog_io.export_products(conn, fmt)
+        finally:
+            conn.close()
+
+    return StreamingResponse(
+        stream(),
+        media_type=CATALOG_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename=products.{fmt}"},
+    )
+
+
+@app.on_event("startup")
+def start_image_gc():
+    images.start_background_gc()
+
+
 @app.post("/api/products/add_product_image")
 def add_product_image(
     file: UploadFile = File(...),
@@ -241,23 +568,122 @@ def add_product_image(
 ):
     try:
         # อัพโหลดไฟล์ไปยัง server
+        # stored under its content hash, so the URL changes with the photo
+        # and can be cached forever (see images.py)
         # Note: You might want to add validation to check file content type, etc.
-        file_location = f"images/{product_id}.jpg"
-        with open(file_location, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        file_location = images.store(file.file, file.filename)
         # อัพเดท product_image ในตาราง products
         mycursor = mydb.cursor()
         sql = "UPDATE products SET product_image = %s WHERE product_id = %s"
-        file_location = f"api/products/images/{product_id}.jpg"
         values = (file_location, product_id)
         mycursor.execute(sql, values)
         mydb.commit()
+        snapshot.mark_dirty()
 
         return {"message": "Image uploaded successfully", "file_path": file_location}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
+class ReservationItem(BaseModel):
+    product_id: int
+    quantity: int = Field(..., gt=0)
+
+
+class ReservationRequest(BaseModel):
+    user_id: int
+    items: List[ReservationItem]
+
+
+@app.on_event("startup")
+def start_inventory_jobs():
+    inventory.start_background_jobs()
+
+
+# hold stock for a checkout; the order service confirms the reservations
+# when the order is placed, otherwise they are released after a TTL
+@app.post("/api/products/reserve_stock", status_code=status.HTTP_201_CREATED)
+def reserve_stock(
+    request: ReservationRequest, current_user: TokenData = Depends(get_current_user)
+):
+    try:
+        reservations = inventory.reserve(
+            mydb,
+            request.user_id,
+            [(item.product_id, item.quantity) for item in request.items],
+        )
+    except inventory.OutOfStock as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"reservations": reservations}
+
+
+@app.post("/api/products/release_reservations")
+def release_reservations(
+    reservation_ids: List[int],
+    user_id: int = Query(...),
+    current_user: TokenData = Depends(get_current_user),
+):
+    # only the given user's reservations, like add_order's confirm
+    released = inventory.release(mydb, reservation_ids, user_id)
+    return {"message": "Reservations released", "released": released}
+
+
+class StockPriceUpdate(BaseModel):
+    product_id: int
+    # absolute warehouse count, or a change to the available count
+    stock_quantity: Optional[int] = Field(None, ge=0)
+    stock_delta: Optional[int] = None
+    price: Optional[float] = Field(None, ge=0)
+
+
+# inventory sync from the warehouse: thousands of stock/price changes
+# applied with a handful of set-based statements in one transaction
+@app.put("/api/products/bulk_update")
+def bulk_update_products(
+    updates: List[StockPriceUpdate],
+    current_user: TokenData = Depends(get_current_user),
+):
+    for update in updates:
+        if update.stock_quantity is not None and update.stock_delta is not None:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Product {update.product_id}: give stock_quantity or stock_delta, not both",
+            )
+    if not updates:
+        return {"received": 0, "updated": 0, "sharded": 0, "not_found": []}
+    # a connection of its own for the temporary table
+    conn = db.connect()
+    try:
+        return inventory.bulk_update(
+            conn,
+            [
+                (u.product_id, u.stock_quantity, u.stock_delta, u.price)
+                for u in updates
+            ],
+        )
+    finally:
+        conn.close()
+
+
+# split a hot product's stock over several rows so checkouts don't queue on
+# one row lock; shards=0 folds the stock back into the product row
+@app.put("/api/products/set_stock_shards")
+def set_stock_shards(
+    product_id: int = Query(...),
+    shards: int = Query(..., ge=0, le=64),
+    current_user: TokenData = Depends(get_current_user),
+):
+    try:
+        stock_quantity = inventory.set_shards(mydb, product_id, shards)
+    except LookupError:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return {
+        "product_id": product_id,
+        "shards": shards,
+        "stock_quantity": stock_quantity,
+    }
+
+
 class Category(BaseModel):
     name: str
 
@@ -269,7 +695,14 @@ class CategoryResponse(BaseModel):
 
 @app.get("/api/products/get_all_categories", response_model=List[CategoryResponse])
 def get_all_categories():
-    mycursor = mydb.cursor()
+    snap = snapshot.current()
+    if snap is not None:
+        body = responses.get(snap.version, "categories")
+        if body is None:
+            body = fastjson.dumps(snap.categories())
+            responses.put(snap.version, "categories", body)
+        return fastjson.response(body=body)
+    mycursor = db.reader().cursor()
     mycursor.execute("SELECT * FROM categories")
     myresult = mycursor.fetchall()
     # Convert tuple results to dictionary format expected by the Pydantic model
@@ -289,6 +722,7 @@ def add_category(
         values = (category.name,)
         mycursor.execute(sql, values)
         mydb.commit()
+        snapshot.mark_dirty()
         return {"message": "Category added successfully"}
     except Exception as e:
         mydb.rollback()
@@ -305,6 +739,7 @@ def delete_category(
         sql = "DELETE FROM categories WHERE category_id = %s"
         mycursor.execute(sql, (category_id,))
         mydb.commit()
+        snapshot.mark_dirty()
         return {"message": "Category deleted successfully"}
     except Exception as e:
         mydb.rollback()
@@ -320,7 +755,7 @@ import IPython
 def get_product_description_tts(
     product_id: int = Query(...),
 ):
-    mycursor = mydb.cursor()
+    mycursor = db.reader().cursor()
     query = "SELECT description FROM products WHERE product_id = %s"
     mycursor.execute(query, (product_id,))
     myresult = mycursor.fetchone()
@@ -330,9 +765,10 @@ def get_product_description_tts(
 
     # Define the path for the audio file
     audio_file_path = f"images/product_{product_id}_audio.wav"
+    audio_file = os.path.join(images.IMAGES_DIR, f"product_{product_id}_audio.wav")
 
     # Check if the audio file already exists
-    if os.path.exists(audio_file_path):
+    if os.path.exists(audio_file):
         return {"message": "Audio already generated", "file_path": audio_file_path}
 
     # API key for the text-to-speech service
@@ -347,7 +783,8 @@ def get_product_description_tts(
         "phrase_break": 0,
         "audiovisual": 0,
     }
-    response = requests.post(url, json=data, headers=headers)
+    with tracing.span("tts.synthesize", tracing.CLIENT, **{"http.url": url}):
+        response = requests.post(url, json=data, headers=headers)
 
     # Check the response
     if response.status_code != 200 or "wav_url" not in response.json():
@@ -355,9 +792,10 @@ def get_product_description_tts(
 
     # Download the audio file
     audio_url = response.json()["wav_url"]
-    resp = requests.get(audio_url, headers={"Apikey": Apikey})
+    with tracing.span("tts.download", tracing.CLIENT, **{"http.url": audio_url}):
+        resp = requests.get(audio_url, headers={"Apikey": Apikey})
     if resp.status_code == 200:
-        with open(audio_file_path, "wb") as f:
+        with open(audio_file, "wb") as f:
             f.write(resp.content)
         return {"message": "Audio generated successfully", "file_path": audio_file_path}
     else:
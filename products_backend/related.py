@@ -0,0 +1,145 @@
+"""Related products ("customers also bought") from order_items co-occurrence.
+
+A background thread keeps a sparse product x product matrix of how many
+orders contain both products, and from it the top-K neighbours of every
+product in two dense arrays indexed by product_id. Serving a lookup is a
+single row read from those arrays.
+
+Refreshes are incremental: only order_items newer than the last one seen
+are read, their co-occurrence counts are added to the matrix and only the
+rows they touch are re-ranked. A full rebuild runs every
+RELATED_FULL_REBUILD_SECONDS to pick up anything an incremental pass missed
+(e.g. a transaction that committed out of id order).
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+import db
+
+TOP_K = int(os.environ.get("RELATED_TOP_K", "20"))
+REFRESH_INTERVAL = int(os.environ.get("RELATED_REFRESH_SECONDS", "60"))
+FULL_REBUILD_INTERVAL = int(os.environ.get("RELATED_FULL_REBUILD_SECONDS", "3600"))
+
+
+class RelatedIndex:
+    def __init__(self, top_k=TOP_K):
+        self.top_k = top_k
+        self.last_order_item_id = 0
+        self.counts = sp.csr_matrix((0, 0), dtype=np.int32)
+        # row = product_id; neighbour id 0 marks an empty slot
+        self.neighbours = np.zeros((0, top_k), dtype=np.int32)
+        self.scores = np.zeros((0, top_k), dtype=np.int32)
+
+    def lookup(self, product_id, limit):
+        # take local references: refresh() swaps both arrays at once
+        neighbours, scores = self.neighbours, self.scores
+        # a negative id would index the array from the end
+        if product_id < 1 or product_id >= len(neighbours):
+            return []
+        row = neighbours[product_id, :limit]
+        found = row != 0
+        return [
+            {"product_id": int(neighbour), "score": int(score)}
+            for neighbour, score in zip(row[found], scores[product_id, :limit][found])
+        ]
+
+    def refresh(self, conn, full=False):
+        """Fold new order_items into the index. Returns how many were read."""
+        last_id = 0 if full else self.last_order_item_id
+        cursor = conn.cursor()
+        query = (
+            "SELECT order_item_id, order_id, product_id FROM order_items"
+            " WHERE order_item_id > %s"
+        )
+        if full:
+            # archived orders (see orders_backend/archive.py) still count
+            query += (
+                " UNION ALL SELECT order_item_id, order_id, product_id"
+                " FROM order_items_archive"
+            )
+        cursor.execute(query, (last_id,))
+        rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+        conn.commit()
+        if len(rows) == 0:
+            if full:
+                self.counts = sp.csr_matrix((0, 0), dtype=np.int32)
+                self.neighbours = np.zeros((0, self.top_k), dtype=np.int32)
+                self.scores = np.zeros((0, self.top_k), dtype=np.int32)
+                self.last_order_item_id = 0
+            return 0
+
+        size = max(self.counts.shape[0], int(rows[:, 2].max(initial=0)) + 1)
+        _, order_index = np.unique(rows[:, 1], return_inverse=True)
+        baskets = sp.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (order_index, rows[:, 2])),
+            shape=(int(order_index.max(initial=-1)) + 1, size),
+        )
+        # a product listed twice in one order still counts once
+        baskets.data[:] = 1
+        delta = (baskets.T @ baskets).tocsr()
+        delta.setdiag(0)
+        delta.eliminate_zeros()
+
+        if full:
+            counts = delta
+            touched = np.arange(size)
+        else:
+            counts = self.counts.copy()
+            counts.resize((size, size))
+            counts = (counts + delta).tocsr()
+            touched = np.unique(delta.nonzero()[0])
+
+        neighbours = np.zeros((size, self.top_k), dtype=np.int32)
+        scores = np.zeros((size, self.top_k), dtype=np.int32)
+        if not full:
+            neighbours[: len(self.neighbours)] = self.neighbours
+            scores[: len(self.scores)] = self.scores
+        for product_id in touched:
+            self._rank(counts, product_id, neighbours, scores)
+
+        self.counts = counts
+        self.neighbours, self.scores = neighbours, scores
+        self.last_order_item_id = max(last_id, int(rows[:, 0].max()))
+        return len(rows)
+
+    def _rank(self, counts, product_id, neighbours, scores):
+        start, end = counts.indptr[product_id], counts.indptr[product_id + 1]
+        columns = counts.indices[start:end]
+        values = counts.data[start:end]
+        if len(values) > self.top_k:
+            best = np.argpartition(-values, self.top_k - 1)[: self.top_k]
+        else:
+            best = np.arange(len(values))
+        best = best[np.argsort(-values[best], kind="stable")]
+        neighbours[product_id] = 0
+        scores[product_id] = 0
+        neighbours[product_id, : len(best)] = columns[best]
+        scores[product_id, : len(best)] = values[best]
+
+
+index = RelatedIndex()
+
+
+def _run_refresh():
+    conn = db.connect()
+    last_full = 0.0
+    while True:
+        try:
+            if not conn.is_connected():
+                conn.reconnect()
+            full = time.monotonic() - last_full >= FULL_REBUILD_INTERVAL
+            index.refresh(conn, full=full)
+            if full:
+                last_full = time.monotonic()
+        except Exception as e:
+            print(f"related products refresh failed: {e}")
+        time.sleep(REFRESH_INTERVAL)
+
+
+def start_background_refresh():
+    threading.Thread(target=_run_refresh, daemon=True).start()
@@ -0,0 +1,56 @@
+"""Units sold per product, for sort=popular.
+
+``product_sales`` holds one row per product (including products that never
+sold) with its category and units sold, indexed on (category_id,
+units_sold) so that a popularity-sorted page is an index range scan like any
+other listing. A background thread recomputes it from order_items every
+SALES_REFRESH_SECONDS; add_product inserts the zero row for new products.
+"""
+
+import os
+import threading
+import time
+
+import db
+
+REFRESH_INTERVAL = int(os.environ.get("SALES_REFRESH_SECONDS", "300"))
+
+
+def refresh(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """
+            INSERT INTO product_sales (product_id, category_id, units_sold)
+            SELECT p.product_id, p.category_id, COALESCE(SUM(oi.quantity), 0)
+            FROM products p
+            LEFT JOIN (
+                SELECT product_id, quantity FROM order_items
+                UNION ALL
+                SELECT product_id, quantity FROM order_items_archive
+            ) oi ON oi.product_id = p.product_id
+            GROUP BY p.product_id, p.category_id
+            ON DUPLICATE KEY UPDATE
+                category_id = VALUES(category_id), units_sold = VALUES(units_sold)
+            """
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _run_refresh():
+    conn = db.connect()
+    while True:
+        try:
+            if not conn.is_connected():
+                conn.reconnect()
+            refresh(conn)
+        except Exception as e:
+            print(f"product sales refresh failed: {e}")
+        time.sleep(REFRESH_INTERVAL)
+
+
+def start_background_refresh():
+    threading.Thread(target=_run_refresh, daemon=True).start()
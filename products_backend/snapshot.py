@@ -0,0 +1,275 @@
+"""Read-only catalog snapshot shared by all worker processes.
+
+One worker (whichever holds the lock file) rebuilds the catalog from MySQL
+every CATALOG_SNAPSHOT_SECONDS, or within a couple of seconds after any
+worker calls ``mark_dirty()`` following a catalog write. It writes the
+snapshot into a single file, by default in /dev/shm. Every worker maps that
+file read-only and serves get_products, get_product_by_id and
+get_all_categories from it. The pages live once in the page cache however
+many workers there are, and nothing is parsed or copied when a snapshot is
+opened.
+
+The file is a small JSON header followed by flat arrays:
+- per product, sorted by product_id: product_id, category_id, price, stock
+  and units_sold
+- the offsets of each product's name, description and image, and of each
+  category name, into one UTF-8 string blob (plus which of them are NULL)
+- per category: category_id
+
+A rebuild writes a new file and renames it over the old one. Readers notice
+the new inode and switch to it; requests already running keep using the
+mapping they started with.
+"""
+
+import fcntl
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import db
+import facets
+
+SNAPSHOT_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+PATH = os.environ.get(
+    "CATALOG_SNAPSHOT_PATH", os.path.join(SNAPSHOT_DIR, "flowerstore-catalog.snapshot")
+)
+REBUILD_INTERVAL = int(os.environ.get("CATALOG_SNAPSHOT_SECONDS", "60"))
+MIN_REBUILD_GAP = float(os.environ.get("CATALOG_SNAPSHOT_MIN_GAP_SECONDS", "2"))
+CHECK_INTERVAL = 0.5
+MAGIC = b"CATSNAP1"
+STRING_FIELDS = ["name", "description", "product_image"]
+NO_CATEGORY = -1
+
+# ORDER BY of main.SORT_ORDERS as (key, reverse) over the snapshot arrays
+SORT_KEYS = {
+    "price_asc": ("price", False),
+    "price_desc": ("price", True),
+    "newest": (None, True),
+    "popular": ("units_sold", True),
+}
+
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
+
+
+class Snapshot:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (header_size,) = struct.unpack_from("<Q", self._map, len(MAGIC))
+        start = len(MAGIC) + 8
+        header = json.loads(self._map[start : start + header_size])
+        data_start = _aligned(start + header_size)
+        self.version = header["version"]
+        self.built_at = header["built_at"]
+        # array offsets in the header are relative to the (aligned) data
+        for name, (offset, dtype, count) in header["arrays"].items():
+            setattr(self, name, np.frombuffer(self._map, dtype, count, data_start + offset))
+
+    def _string(self, index):
+        if self.string_is_null[index]:
+            return None
+        return bytes(self.blob[self.string_offsets[index] : self.string_offsets[index + 1]]).decode()
+
+    def _category_name(self, category_id):
+        i = np.searchsorted(self.category_ids, category_id)
+        if i < len(self.category_ids) and self.category_ids[i] == category_id:
+            return self._string(self.category_name_offsets[i])
+        return None
+
+    def _value(self, row, field):
+        if field == "product_id":
+            return int(self.product_ids[row])
+        if field == "category_id":
+            category_id = int(self.category_id[row])
+            return None if category_id == NO_CATEGORY else category_id
+        if field == "category_name":
+            return self._category_name(self.category_id[row])
+        if field == "price":
+            price = float(self.price[row])
+            return None if np.isnan(price) else price
+        if field == "stock_quantity":
+            return int(self.stock[row])
+        return self._string(row * len(STRING_FIELDS) + STRING_FIELDS.index(field))
+
+    def product(self, product_id, fields):
+        row = np.searchsorted(self.product_ids, product_id)
+        if row >= len(self.product_ids) or self.product_ids[row] != product_id:
+            return None
+        return {field: self._value(row, field) for field in fields}
+
+    def products(self, fields, category_id, bucket, in_stock, sort, offset, limit):
+        """One page of a listing and the total number of matching products."""
+        mask = np.ones(len(self.product_ids), dtype=bool)
+        if category_id is not None:
+            mask &= self.category_id == category_id
+        if bucket is not None:
+            min_price, max_price = facets.price_range(bucket)
+            mask &= self.price >= min_price
+            if max_price is not None:
+                mask &= self.price < max_price
+        if in_stock is not None:
+            mask &= (self.stock > 0) if in_stock else (self.stock <= 0)
+        rows = np.flatnonzero(mask)
+        if sort is not None:
+            key, reverse = SORT_KEYS[sort]
+            if key is not None:
+                # NULL prices sort first, as in MySQL
+                values = np.nan_to_num(getattr(self, key)[rows], nan=-np.inf)
+                # rows are in product_id order, so a stable sort keeps ties
+                # ordered by product_id like the SQL does
+                rows = rows[np.argsort(values, kind="stable")]
+            if reverse:
+                rows = rows[::-1]
+        page = rows[offset : offset + limit]
+        return [{field: self._value(row, field) for field in fields} for row in page], len(rows)
+
+    def categories(self):
+        return [
+            {"category_id": int(category_id), "name": self._string(offset)}
+            for category_id, offset in zip(self.category_ids, self.category_name_offsets)
+        ]
+
+
+def build(conn, path=PATH):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT p.product_id, p.category_id, p.price, p.stock_quantity,
+               COALESCE(s.units_sold, 0), p.name, p.description, p.product_image
+        FROM products p LEFT JOIN product_sales s ON s.product_id = p.product_id
+        ORDER BY p.product_id
+    """
+    )
+    products = cursor.fetchall()
+    cursor.execute("SELECT category_id, name FROM categories ORDER BY category_id")
+    categories = cursor.fetchall()
+    conn.commit()
+
+    strings = [value for row in products for value in row[5:]]
+    strings += [name for _, name in categories]
+    encoded = [(value or "").encode() for value in strings]
+    string_offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+    np.cumsum([len(value) for value in encoded], out=string_offsets[1:])
+    first_category_string = len(products) * len(STRING_FIELDS)
+    arrays = {
+        "product_ids": np.array([row[0] for row in products], dtype="<i8"),
+        "category_id": np.array(
+            [NO_CATEGORY if row[1] is None else row[1] for row in products], dtype="<i8"
+        ),
+        "price": np.array(
+            [np.nan if row[2] is None else float(row[2]) for row in products], dtype="<f8"
+        ),
+        "stock": np.array([row[3] or 0 for row in products], dtype="<i8"),
+        "units_sold": np.array([row[4] for row in products], dtype="<i8"),
+        "category_ids": np.array([row[0] for row in categories], dtype="<i8"),
+        "category_name_offsets": np.arange(
+            first_category_string, first_category_string + len(categories), dtype="<i8"
+        ),
+        "string_offsets": string_offsets,
+        "string_is_null": np.array([value is None for value in strings], dtype="u1"),
+        "blob": np.frombuffer(b"".join(encoded), dtype="u1"),
+    }
+
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = [offset, array.dtype.str, len(array)]
+        offset += _aligned(array.nbytes)
+    header = {"version": time.time_ns(), "built_at": time.time(), "arrays": layout}
+    encoded_header = json.dumps(header).encode()
+    data_start = _aligned(len(MAGIC) + 8 + len(encoded_header))
+
+    directory = os.path.dirname(path) or "."
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as tmp:
+        tmp.write(MAGIC + struct.pack("<Q", len(encoded_header)) + encoded_header)
+        tmp.write(b"\0" * (data_start - tmp.tell()))
+        for name, array in arrays.items():
+            tmp.write(array.tobytes())
+            tmp.write(b"\0" * (-array.nbytes % 8))
+    os.chmod(tmp.name, 0o644)
+    os.replace(tmp.name, path)
+    return header["version"]
+
+
+_current = None
+_current_key = None
+_checked_at = 0.0
+_open_lock = threading.Lock()
+
+
+def current():
+    """The latest snapshot, or None until the first one has been built."""
+    global _current, _current_key, _checked_at
+    now = time.monotonic()
+    if now - _checked_at < CHECK_INTERVAL:
+        return _current
+    with _open_lock:
+        if now - _checked_at < CHECK_INTERVAL:
+            return _current
+        _checked_at = now
+        try:
+            stat = os.stat(PATH)
+        except FileNotFoundError:
+            return _current
+        key = (stat.st_ino, stat.st_mtime_ns)
+        if key != _current_key:
+            try:
+                _current = Snapshot(PATH)
+                _current_key = key
+            except Exception as e:
+                print(f"catalog snapshot could not be opened: {e}")
+        return _current
+
+
+def mark_dirty():
+    """Ask the builder (in whichever worker) for a rebuild soon."""
+    try:
+        with open(PATH + ".dirty", "a"):
+            os.utime(PATH + ".dirty")
+    except OSError as e:
+        print(f"catalog snapshot could not be marked dirty: {e}")
+
+
+def _dirty_since(built_at):
+    try:
+        return os.stat(PATH + ".dirty").st_mtime > built_at
+    except FileNotFoundError:
+        return False
+
+
+def _run_builder():
+    # one builder across all workers; the others only read. The lock is
+    # held for the life of the process and released by the OS if it dies,
+    # then another worker takes over on its next try.
+    lock = open(PATH + ".lock", "a")
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except OSError:
+            time.sleep(REBUILD_INTERVAL)
+    conn = db.connect()
+    built_at = 0.0
+    while True:
+        if time.time() - built_at >= REBUILD_INTERVAL or _dirty_since(built_at):
+            # taken before reading, so a write during the build re-dirties it
+            built_at = time.time()
+            try:
+                if not conn.is_connected():
+                    conn.reconnect()
+                build(conn)
+            except Exception as e:
+                print(f"catalog snapshot build failed: {e}")
+        time.sleep(MIN_REBUILD_GAP)
+
+
+def start_background_builder():
+    threading.Thread(target=_run_builder, daemon=True).start()